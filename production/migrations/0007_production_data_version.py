@@ -0,0 +1,18 @@
+# Generated by Django 3.2.25 on 2026-10-18 18:51
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('production', '0006_auto_20200607_0201'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='production',
+            name='data_version',
+            field=models.IntegerField(default=0, editable=False, verbose_name='データのバージョン'),
+        ),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 3.2.25 on 2026-10-18 19:17
+
+from django.db import migrations, models
+
+
+def merge_duplicate_prod_users(apps, schema_editor):
+    '''同じ公演とユーザの公演ユーザが複数あれば、権限をまとめて1つにする
+    '''
+    ProdUser = apps.get_model('production', 'ProdUser')
+    kept = {}
+    for prod_user in ProdUser.objects.order_by('id'):
+        key = (prod_user.production_id, prod_user.user_id)
+        if key not in kept:
+            kept[key] = prod_user
+            continue
+        first = kept[key]
+        if (prod_user.is_owner and not first.is_owner)\
+                or (prod_user.is_editor and not first.is_editor):
+            first.is_owner = first.is_owner or prod_user.is_owner
+            first.is_editor = first.is_editor or prod_user.is_editor
+            first.save()
+        prod_user.delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('production', '0007_production_data_version'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_duplicate_prod_users,
+            migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='produser',
+            constraint=models.UniqueConstraint(fields=('production', 'user'), name='produser_prod_user_unique'),
+        ),
+    ]
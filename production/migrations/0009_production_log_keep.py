@@ -0,0 +1,23 @@
+# Generated by Django 3.2.25 on 2026-10-18 19:18
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('production', '0008_produser_unique'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='production',
+            name='log_keep_days',
+            field=models.PositiveIntegerField(blank=True, null=True, verbose_name='変更履歴の保存日数'),
+        ),
+        migrations.AddField(
+            model_name='production',
+            name='log_keep_rows',
+            field=models.PositiveIntegerField(blank=True, null=True, verbose_name='変更履歴の保存件数'),
+        ),
+    ]
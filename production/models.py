@@ -7,12 +7,49 @@ class Production(models.Model):
     '''公演
     '''
     name = models.CharField('公演名', max_length=50)
+    # 稽古のデータ (出欠、出番など) が変更されるたびに増える
+    data_version = models.IntegerField('データのバージョン', default=0,
+        editable=False)
+    # 出欠の変更履歴を残す期間と件数 (空ならサイトの設定に従う)
+    log_keep_days = models.PositiveIntegerField('変更履歴の保存日数',
+        blank=True, null=True)
+    log_keep_rows = models.PositiveIntegerField('変更履歴の保存件数',
+        blank=True, null=True)
     
     class Meta:
         verbose_name = verbose_name_plural = '公演'
     
     def __str__(self):
         return self.name
+    
+    def save(self, *args, **kwargs):
+        '''保存する
+        
+        data_version は update_data_version() でだけ進める
+        読み込んだ時の古い値で上書きして戻さないように、更新する時は
+        data_version 以外のフィールドだけを保存する
+        '''
+        if not self._state.adding and not kwargs.get('force_insert'):
+            update_fields = kwargs.get('update_fields')
+            if update_fields is None:
+                update_fields = [field.name
+                    for field in self._meta.concrete_fields
+                    if not field.primary_key]
+            kwargs['update_fields'] = [name for name in update_fields
+                if name != 'data_version']
+        super().save(*args, **kwargs)
+    
+    @classmethod
+    def update_data_version(cls, *prod_ids):
+        '''公演のデータのバージョンを進める
+        
+        Parameters
+        ----------
+        prod_ids : int
+            公演の id (複数可)
+        '''
+        cls.objects.filter(pk__in=prod_ids).update(
+            data_version=models.F('data_version') + 1)
 
 
 class ProdUser(models.Model):
@@ -27,6 +64,10 @@ class ProdUser(models.Model):
     
     class Meta:
         verbose_name = verbose_name_plural = '公演ユーザ'
+        constraints = [
+            models.UniqueConstraint(fields=['production', 'user'],
+                name='produser_prod_user_unique'),
+        ]
     
     def __str__(self):
         first_name = self.user.first_name
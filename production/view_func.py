@@ -14,11 +14,33 @@ def accessing_prod_user(view, prod_id=None):
     '''
     if not prod_id:
         prod_id=view.kwargs['prod_id']
-    prod_users = ProdUser.objects.filter(
-        production__pk=prod_id, user=view.request.user)
-    if len(prod_users) < 1:
-        return None
-    return prod_users[0]
+    prod_id = int(prod_id)
+    prod_users = request_prod_users(view.request)
+    if prod_id not in prod_users:
+        # リクエスト中に追加された場合のために、データベースも見ておく
+        prod_users[prod_id] = ProdUser.objects.filter(
+            production__pk=prod_id, user=view.request.user)\
+            .select_related('production').first()
+    return prod_users[prod_id]
+
+
+def request_prod_users(request):
+    '''アクセス中のユーザの ProdUser を、リクエストごとに1回だけ取得する
+    
+    Returns
+    -------
+    prod_users : dict
+        公演の id をキーにした ProdUser の dict (リクエストに持っておく)
+    '''
+    prod_users = getattr(request, '_prod_users', None)
+    if prod_users is None:
+        prod_users = {}
+        if request.user.is_authenticated:
+            for prod_user in ProdUser.objects.filter(user=request.user)\
+                    .select_related('production'):
+                prod_users.setdefault(prod_user.production_id, prod_user)
+        request._prod_users = prod_users
+    return prod_users
 
 
 def test_edit_permission(view, prod_id=None):
@@ -69,7 +69,7 @@ class ProdUpdate(LoginRequiredMixin, UpdateView):
     '''Production の更新ビュー
     '''
     model = Production
-    fields = ('name',)
+    fields = ('name', 'log_keep_days', 'log_keep_rows')
     success_url = reverse_lazy('production:prod_list')
     
     def get(self, request, *args, **kwargs):
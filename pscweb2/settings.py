@@ -136,6 +136,37 @@ AUTHENTICATION_BACKENDS = [
     'django.contrib.auth.backends.ModelBackend',
 ]
 
+# Cache
+# https://docs.djangoproject.com/en/2.2/topics/cache/
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        # 台本の断片を見出しごとに入れるので、既定 (300) より多く持つ
+        'OPTIONS': {
+            'MAX_ENTRIES': 20000,
+        },
+    }
+}
+
+# 稽古可能性の計算方法
+# 'python': 時間スロットごとに計算する
+# 'numpy': 分単位の出席の行列で計算する (numpy が必要)
+RHSL_PSBLTY_BACKEND = 'python'
+
+# パースした台本をプロセス内にキャッシュする上限
+# (パースした結果のおよそのバイト数の合計. 台本の文字数のおよそ 15 倍)
+# これより大きい台本はキャッシュせず、その都度パースする
+SCRIPT_PARSE_CACHE_SIZE = 64 * 1024 * 1024
+
+# これより長い (文字数) 台本は、HTML を保存せず、ビューアで少しずつ送る
+SCRIPT_VIEWER_STREAMING_SIZE = 1024 * 1024
+
+# 出欠の変更履歴を残す期間と件数 (公演ごとに指定がない場合, None なら無制限)
+# manage.py prune_atnd_change_logs で削除する
+ATND_CHANGE_LOG_KEEP_DAYS = None
+ATND_CHANGE_LOG_KEEP_ROWS = None
+
 # ローカル設定があれば開発環境、なければ本番環境
 DEBUG = False
 
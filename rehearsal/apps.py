@@ -3,3 +3,7 @@ from django.apps import AppConfig
 
 class RehearsalConfig(AppConfig):
     name = 'rehearsal'
+    
+    def ready(self):
+        # データのバージョンを進めるシグナルを登録する
+        from . import signals
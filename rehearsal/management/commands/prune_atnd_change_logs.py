@@ -0,0 +1,114 @@
+import gzip
+import json
+import os
+from datetime import timedelta
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Q
+from django.utils import timezone
+from production.models import Production
+from rehearsal.models import AtndChangeLog
+
+
+class Command(BaseCommand):
+    '''保存期間や件数を超えた出欠の変更履歴を削除するコマンド
+    '''
+    help = '保存期間や件数を超えた出欠の変更履歴を、少しずつ削除する'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000,
+            help='1回に削除する件数')
+        parser.add_argument('--archive-dir',
+            help='削除する前に、このディレクトリに JSON Lines (gzip) で保存する')
+        parser.add_argument('--dry-run', action='store_true',
+            help='削除せずに、削除する件数だけを表示する')
+
+    def handle(self, *args, **options):
+        archive = None
+        if options['archive_dir'] and not options['dry_run']:
+            # 同じ名前のファイルがあれば、後ろに追加する
+            path = os.path.join(options['archive_dir'], timezone.now()
+                .strftime('atnd_change_logs_%Y%m%d%H%M%S.jsonl.gz'))
+            archive = gzip.open(path, 'at', encoding='utf-8')
+
+        try:
+            for production in Production.objects.order_by('id'):
+                logs = self.expired_logs(production)
+                if logs is None:
+                    continue
+                if options['dry_run']:
+                    deleted = logs.count()
+                else:
+                    deleted = self.delete_logs(logs, options['batch_size'],
+                        archive)
+                if deleted:
+                    self.stdout.write('{}: {} 件'.format(production, deleted))
+        finally:
+            if archive:
+                archive.close()
+
+    def expired_logs(self, production):
+        '''公演の、保存期間または件数を超えた変更履歴を返す
+
+        Returns
+        -------
+        logs : QuerySet
+            削除する変更履歴. 期間も件数も無制限なら None
+        '''
+        keep_days = production.log_keep_days
+        if keep_days is None:
+            keep_days = settings.ATND_CHANGE_LOG_KEEP_DAYS
+        keep_rows = production.log_keep_rows
+        if keep_rows is None:
+            keep_rows = settings.ATND_CHANGE_LOG_KEEP_ROWS
+        if keep_days is None and keep_rows is None:
+            return None
+
+        logs = AtndChangeLog.objects.filter(production=production)
+        expired = Q(pk__in=[])
+
+        # 保存期間より古いもの
+        if keep_days is not None:
+            expired |= Q(
+                create_dt__lt=timezone.now() - timedelta(days=keep_days))
+
+        # 新しい方から数えて、保存件数より後のもの
+        if keep_rows is not None:
+            last_kept = logs.order_by('-create_dt', '-id')\
+                .values_list('create_dt', 'id')[keep_rows:keep_rows + 1]
+            if last_kept:
+                create_dt, log_id = last_kept[0]
+                expired |= Q(create_dt__lt=create_dt)\
+                    | Q(create_dt=create_dt, id__lte=log_id)
+
+        return logs.filter(expired)
+
+    def delete_logs(self, logs, batch_size, archive):
+        '''変更履歴を batch_size 件ずつ削除する
+
+        1回ごとにコミットするので、テーブルを長くロックしない
+
+        Returns
+        -------
+        deleted : int
+            削除した件数
+        '''
+        deleted = 0
+        while True:
+            ids = list(logs.order_by('id').values_list('id', flat=True)
+                [:batch_size])
+            if not ids:
+                break
+
+            # 削除する前に保存する
+            if archive:
+                for row in AtndChangeLog.objects.filter(id__in=ids)\
+                        .order_by('id').values():
+                    archive.write(json.dumps(row, cls=DjangoJSONEncoder,
+                        ensure_ascii=False) + '\n')
+                # 削除をコミットする前に、ファイルに書き出しておく
+                archive.flush()
+
+            deleted += AtndChangeLog.objects.filter(id__in=ids).delete()[0]
+        return deleted
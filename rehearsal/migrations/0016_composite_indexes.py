@@ -0,0 +1,46 @@
+# Generated by Django 3.2.25 on 2026-10-18 19:17
+
+from django.db import migrations, models
+
+
+def delete_duplicate_appearances(apps, schema_editor):
+    '''同じシーンと登場人物の出番が複数あれば、最初のものだけ残す
+    '''
+    Appearance = apps.get_model('rehearsal', 'Appearance')
+    seen = set()
+    dupe_ids = []
+    for appr_id, scene_id, character_id in Appearance.objects\
+            .order_by('id').values_list('id', 'scene_id', 'character_id'):
+        if (scene_id, character_id) in seen:
+            dupe_ids.append(appr_id)
+        else:
+            seen.add((scene_id, character_id))
+    Appearance.objects.filter(id__in=dupe_ids).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rehearsal', '0015_auto_20200607_0201'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='atndchangelog',
+            index=models.Index(fields=['production', '-create_dt'], name='atndchangelog_prod_dt_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='attendance',
+            index=models.Index(fields=['rehearsal', 'actor'], name='attendance_rhsl_actr_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='rehearsal',
+            index=models.Index(fields=['production', 'date', 'start_time'], name='rehearsal_prod_date_idx'),
+        ),
+        migrations.RunPython(delete_duplicate_appearances,
+            migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='appearance',
+            constraint=models.UniqueConstraint(fields=('scene', 'character'), name='appearance_scene_chr_unique'),
+        ),
+    ]
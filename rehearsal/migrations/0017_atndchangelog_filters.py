@@ -0,0 +1,40 @@
+# Generated by Django 3.2.25 on 2026-10-18 19:20
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rehearsal', '0016_composite_indexes'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='atndchangelog',
+            name='atndchangelog_prod_dt_idx',
+        ),
+        migrations.AddField(
+            model_name='atndchangelog',
+            name='actor',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='rehearsal.actor', verbose_name='役者'),
+        ),
+        migrations.AddField(
+            model_name='atndchangelog',
+            name='rehearsal',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='rehearsal.rehearsal', verbose_name='稽古のコマ'),
+        ),
+        migrations.AddIndex(
+            model_name='atndchangelog',
+            index=models.Index(fields=['production', '-create_dt', '-id'], name='atndchangelog_prod_dt_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='atndchangelog',
+            index=models.Index(fields=['actor', '-create_dt', '-id'], name='atndchangelog_actr_dt_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='atndchangelog',
+            index=models.Index(fields=['production', 'changed_by_id', '-create_dt'], name='atndchangelog_chgr_dt_idx'),
+        ),
+    ]
@@ -0,0 +1,53 @@
+# Generated by Django 3.2.25 on 2026-10-18 19:21
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rehearsal', '0017_atndchangelog_filters'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='atndchangelog',
+            name='new_from_min',
+            field=models.PositiveSmallIntegerField(blank=True, null=True, verbose_name='変更後の From (分)'),
+        ),
+        migrations.AddField(
+            model_name='atndchangelog',
+            name='new_state',
+            field=models.PositiveSmallIntegerField(blank=True, choices=[(0, 'なし'), (1, '時間帯'), (2, '全日'), (3, '欠席')], null=True, verbose_name='変更後の状態'),
+        ),
+        migrations.AddField(
+            model_name='atndchangelog',
+            name='new_to_min',
+            field=models.PositiveSmallIntegerField(blank=True, null=True, verbose_name='変更後の To (分)'),
+        ),
+        migrations.AddField(
+            model_name='atndchangelog',
+            name='old_from_min',
+            field=models.PositiveSmallIntegerField(blank=True, null=True, verbose_name='変更前の From (分)'),
+        ),
+        migrations.AddField(
+            model_name='atndchangelog',
+            name='old_state',
+            field=models.PositiveSmallIntegerField(blank=True, choices=[(0, 'なし'), (1, '時間帯'), (2, '全日'), (3, '欠席')], null=True, verbose_name='変更前の状態'),
+        ),
+        migrations.AddField(
+            model_name='atndchangelog',
+            name='old_to_min',
+            field=models.PositiveSmallIntegerField(blank=True, null=True, verbose_name='変更前の To (分)'),
+        ),
+        migrations.AlterField(
+            model_name='atndchangelog',
+            name='new_value',
+            field=models.CharField(blank=True, max_length=50, verbose_name='変更後'),
+        ),
+        migrations.AlterField(
+            model_name='atndchangelog',
+            name='old_value',
+            field=models.CharField(blank=True, max_length=50, verbose_name='変更前'),
+        ),
+    ]
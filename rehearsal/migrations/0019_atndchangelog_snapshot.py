@@ -0,0 +1,49 @@
+# Generated by Django 3.2.25 on 2026-10-18 19:52
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def fill_snapshots(apps, schema_editor):
+    '''記録済みの変更履歴に、稽古の日付と役者の短縮名を入れる
+    '''
+    AtndChangeLog = apps.get_model('rehearsal', 'AtndChangeLog')
+    logs = AtndChangeLog.objects.filter(old_state__isnull=False)\
+        .select_related('rehearsal', 'actor')
+    for log in logs:
+        if log.rehearsal:
+            log.rehearsal_date = log.rehearsal.date
+        if log.actor:
+            log.actor_name = log.actor.short_name or log.actor.name[:3]
+        log.save(update_fields=['rehearsal_date', 'actor_name'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rehearsal', '0018_atndchangelog_structured'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='atndchangelog',
+            name='actor_name',
+            field=models.CharField(blank=True, max_length=50, verbose_name='役者の短縮名'),
+        ),
+        migrations.AddField(
+            model_name='atndchangelog',
+            name='rehearsal_date',
+            field=models.DateField(blank=True, null=True, verbose_name='稽古の日付'),
+        ),
+        migrations.AlterField(
+            model_name='atndchangelog',
+            name='actor',
+            field=models.ForeignKey(blank=True, db_constraint=False, null=True, on_delete=django.db.models.deletion.DO_NOTHING, to='rehearsal.actor', verbose_name='役者'),
+        ),
+        migrations.AlterField(
+            model_name='atndchangelog',
+            name='rehearsal',
+            field=models.ForeignKey(blank=True, db_constraint=False, null=True, on_delete=django.db.models.deletion.DO_NOTHING, to='rehearsal.rehearsal', verbose_name='稽古のコマ'),
+        ),
+        migrations.RunPython(fill_snapshots, migrations.RunPython.noop),
+    ]
@@ -1,131 +1,513 @@
+from operator import itemgetter
+from django.conf import settings
 from .models import *
 
-def time_slots_for_rehearsal(rehearsal, actors=None, scenes=None):
-    '''稽古を指定して、全シーンの時間スロットのリストを得る
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+def time_to_minutes(time):
+    '''time を 0:00 からの分数に変換する
     '''
-    
-    def actor_info_in_scene(actor, scene):
-        '''指定した役者の、あるシーンでの役とセリフ数をリストにして返す
-        
-        Returns
-        -------
-        [
-            {
-                actor: actor,
-                apearances: [{
-                    character: character,
-                    lines_num: lines_num
-                }]
-            }
-        ]
-        '''
-        # この役者が演じている役
-        chrs = actor.character_set.all()
-        
-        # それらの役の、このシーンでの出番
-        apprs = []
-        for chr in chrs:
-            apprs.extend(list(chr.appearance_set.filter(scene=scene)))
-        
-        average_lines_num = Appearance.average_lines_num(apprs)
-        
-        return {
-            'actor': actor,
-            'appearances': [{
-                'character': appr.character,
-                'lines_num': average_lines_num if appr.lines_auto
-                                else appr.lines_num
-            } for appr in apprs]
-        }
-    
-    # ここからメインルーチン
-    prod_id = rehearsal.production.id
-    
-    if not actors:
-        actors = Actor.objects.filter(production__pk=prod_id)
-    
-    if not scenes:
-        scenes = Scene.objects.filter(production__pk=prod_id)
-    
-    # この稽古の、全役者の in/out 時刻のリスト
+    return time.hour * 60 + time.minute
+
+
+def minutes_to_str(minutes):
+    '''0:00 からの分数を 'HH:MM' 形式の文字列に変換する
+    '''
+    return '{:02d}:{:02d}'.format(*divmod(minutes, 60))
+
+
+def bits_to_idxs(bits):
+    '''ビットセットから、立っているビットのインデックスのリストを得る
+    '''
+    idxs = []
+    idx = 0
+    while bits:
+        if bits & 1:
+            idxs.append(idx)
+        bits >>= 1
+        idx += 1
+    return idxs
+
+
+def time_borders_for_rehearsal(rehearsal, attendances, actr_idxs):
+    '''稽古の、全役者の in/out 時刻のリストを時刻順に得る
+
+    Parameters
+    ----------
+    rehearsal : Rehearsal
+        対象の稽古
+    attendances : iterable
+        この稽古の Attendance (id 順)
+    actr_idxs : dict
+        役者の id から役者のインデックスへの dict
+        含まれない役者の参加時間は無視する
+
+    Returns
+    -------
+    time_borders : list
+        (時刻 (分), 役者のインデックス, in なら True) のリスト
+        同時刻の境界は役者のインデックス順、同じ役者なら参加時間の順
+    '''
+    start_time = time_to_minutes(rehearsal.start_time)
+    end_time = time_to_minutes(rehearsal.end_time)
+
     time_borders = []
-    for actr in actors:
-        atnds = actr.attendance_set.filter(rehearsal=rehearsal)
-        for atnd in atnds:
-            # 欠席なら除外
-            if atnd.is_absent:
+    for atnd in attendances:
+        # 欠席なら除外
+        if atnd.is_absent:
+            continue
+        actr_idx = actr_idxs.get(atnd.actor_id)
+        if actr_idx is None:
+            continue
+        # 稽古の開始時刻～終了時刻に収まるよう補正する
+        if atnd.is_allday:
+            from_time, to_time = start_time, end_time
+        else:
+            from_time = min(max(time_to_minutes(atnd.from_time), start_time),
+                end_time)
+            to_time = min(max(time_to_minutes(atnd.to_time), start_time),
+                end_time)
+        time_borders.append((from_time, actr_idx, True))
+        time_borders.append((to_time, actr_idx, False))
+
+    # 時刻と役者でソート (同じ役者の in -> out の順序は保たれる)
+    time_borders.sort(key=itemgetter(0, 1))
+
+    return time_borders
+
+
+def scene_time_slots(rehearsal, time_borders, scn_actr_bits):
+    '''稽古のシーンごとの時間スロットを、境界を1回走査して得る
+
+    シーンごとの時間スロットは、そのシーンに出ている役者の in/out で区切る
+
+    Parameters
+    ----------
+    rehearsal : Rehearsal
+        対象の稽古
+    time_borders : list
+        time_borders_for_rehearsal() で得た in/out 時刻のリスト
+    scn_actr_bits : list
+        シーンごとの、出ている役者のインデックスのビットを立てた int のリスト
+
+    Returns
+    -------
+    scns_time_slots : list
+        シーンごとの、(開始時刻 (分), 終了時刻 (分), 出席している役者のビットセット)
+        のリスト
+    '''
+    start_time = time_to_minutes(rehearsal.start_time)
+    end_time = time_to_minutes(rehearsal.end_time)
+
+    scns_time_slots = [[] for actr_bits in scn_actr_bits]
+    scns_time = [start_time] * len(scn_actr_bits)
+    attendee = 0
+
+    border_idx = 0
+    while border_idx < len(time_borders):
+        time = time_borders[border_idx][0]
+
+        # 同時刻の境界をまとめて、出入りする役者のビットセットを作る
+        next_idx = border_idx
+        moved = 0
+        while next_idx < len(time_borders)\
+                and time_borders[next_idx][0] == time:
+            moved |= 1 << time_borders[next_idx][1]
+            next_idx += 1
+
+        # 出入りする役者が出ているシーンは、次の時間ならスロット追加
+        for scn_idx, actr_bits in enumerate(scn_actr_bits):
+            if (actr_bits & moved) and time > scns_time[scn_idx]:
+                scns_time_slots[scn_idx].append(
+                    (scns_time[scn_idx], time, attendee & actr_bits))
+                scns_time[scn_idx] = time
+
+        for _, actr_idx, is_in in time_borders[border_idx:next_idx]:
+            if is_in:
+                attendee |= 1 << actr_idx
+            else:
+                attendee &= ~(1 << actr_idx)
+
+        border_idx = next_idx
+
+    # 稽古の終了時刻に達していなかったらスロット追加
+    for scn_idx, actr_bits in enumerate(scn_actr_bits):
+        if end_time > scns_time[scn_idx]:
+            scns_time_slots[scn_idx].append(
+                (scns_time[scn_idx], end_time, attendee & actr_bits))
+
+    return scns_time_slots
+
+
+class AppearanceMatrix:
+    '''公演の出番を、シーン x 登場人物の疎行列として持つ
+
+    出番は1回のクエリで取得する
+    香盤表、出欠表、出欠グラフ、稽古可能性で共通して使う
+
+    Attributes
+    ----------
+    scenes : list
+        行に対応する Scene のリスト
+    characters : list
+        列に対応する Character のリスト
+    actors : list
+        シーン x 役者の行列の列に対応する Actor のリスト
+    cast_idxs : list
+        登場人物ごとの、配役の actors でのインデックス (配役がなければ -1)
+    actr_idxs : dict
+        役者の id から actors でのインデックスへの dict
+    scns_apprs : list
+        シーンごとの、登場人物のインデックスから (セリフ数, セリフ数を決めない)
+        への dict (出番の id 順)
+    '''
+    def __init__(self, prod_id, scenes=None, characters=None, actors=None):
+        '''公演の出番を取得して行列を作る
+
+        Parameters
+        ----------
+        prod_id : int
+            公演の id
+        scenes : list
+            行に対応する Scene のリスト. 省略すると公演の全シーン
+        characters : list
+            列に対応する Character のリスト. 省略すると公演の全登場人物
+        actors : list
+            シーン x 役者の行列の列に対応する Actor のリスト
+            省略すると公演の全役者
+        '''
+        if scenes is None:
+            scenes = Scene.objects.filter(production__pk=prod_id)
+        if characters is None:
+            characters = Character.objects.filter(production__pk=prod_id)
+        if actors is None:
+            actors = Actor.objects.filter(production__pk=prod_id)
+        self.scenes = list(scenes)
+        self.characters = list(characters)
+        self.actors = list(actors)
+
+        self.actr_idxs = {
+            actr.id: actr_idx for actr_idx, actr in enumerate(self.actors)}
+        self.cast_idxs = [self.actr_idxs.get(chr.cast_id, -1)
+            for chr in self.characters]
+
+        scn_idxs = {scn.id: scn_idx for scn_idx, scn in enumerate(self.scenes)}
+        chr_idxs = {chr.id: chr_idx
+            for chr_idx, chr in enumerate(self.characters)}
+
+        self.scns_apprs = [{} for scn in self.scenes]
+        appearances = Appearance.objects.filter(scene__production__pk=prod_id)\
+            .order_by('id').values_list(
+                'scene_id', 'character_id', 'lines_num', 'lines_auto')
+        for scn_id, chr_id, lines_num, lines_auto in appearances:
+            scn_idx = scn_idxs.get(scn_id)
+            chr_idx = chr_idxs.get(chr_id)
+            if scn_idx is None or chr_idx is None:
                 continue
-            # in 時刻 - 稽古の開始時刻～終了時刻に収まるよう補正する
-            from_time = rehearsal.start_time if atnd.is_allday\
-                else min(max(atnd.from_time, rehearsal.start_time),
-                    rehearsal.end_time)
-            time_borders.append({
-                'time': from_time,
-                'actor': actr,
-                'move': 'in'
-            })
-            # out 時刻 - 稽古の開始時刻～終了時刻に収まるよう補正する
-            to_time = rehearsal.end_time if atnd.is_allday\
-                else min(max(atnd.to_time, rehearsal.start_time),
-                    rehearsal.end_time)
-            time_borders.append({
-                'time': to_time,
-                'actor': actr,
-                'move': 'out'
-             })
-    
-    # シーンごとの時間スロット
-    scns_time_slots = []
-    for scene in scenes:
-        # このシーンの出番のリスト
-        scn_apprs = [appr for appr in scene.appearance_set.all()]
-        # このシーンの役者のリスト
-        scn_actrs = [appr.character.cast for appr in scn_apprs]
-        # 重複を削除
-        scn_actrs = list(set(scn_actrs))
-        
-        # このシーンに出ている役者の時間スロットの境界のリスト
-        scn_time_borders = [
-            border for border in time_borders
-            if border['actor'] in scn_actrs]
-        
-        # scn_time_borders から、このシーンの時間スロットを作る
-        # time でソート (in -> out の順序は保たれる)
-        scn_time_borders = sorted(scn_time_borders, key=lambda x:x['time'])
-        
-        time = rehearsal.start_time
-        slots = []
-        attendee = set()
-        for border in scn_time_borders:
-            # 次の時間ならスロット追加
-            if border['time'] > time:
-                slots.append({
-                    'from_time': time,
-                    'to_time': border['time'],
-                    'attendee': [actor_info_in_scene(actr, scene) for actr in attendee]
-                })
-                # 次のスロット開始
-                time = border['time']
-            
-            if border['move'] == 'in':
-                attendee.add(border['actor'])
-            if border['move'] == 'out':
-                attendee.discard(border['actor'])
-        
-        # 稽古の終了時刻に達していなかったらスロット追加
-        if rehearsal.end_time > time:
-            slots.append({
-                'from_time': time,
-                'to_time': rehearsal.end_time,
-                'attendee': [actor_info_in_scene(actr, scene) for actr in attendee]
-            })
-        
-        # シーンごとのデータとしてリストに追加
-        scns_time_slots.append({
-            'scene_id': scene.id,
-            'scene': scene,
-            # 'chrs_num': chrs_num,
-            'time_slots': slots
+            # 同じ登場人物の出番が複数あれば、最初のものを使う
+            self.scns_apprs[scn_idx].setdefault(
+                chr_idx, (lines_num, lines_auto))
+
+    @staticmethod
+    def average_lines_num(apprs, default=1):
+        '''(セリフ数, セリフ数を決めない) のリストのセリフ数の平均値を返す
+
+        セリフ数が「自動」でないものがなければ、default を返す
+        '''
+        lines_nums = [
+            lines_num for lines_num, lines_auto in apprs if not lines_auto]
+        return sum(lines_nums) / len(lines_nums) if len(lines_nums) > 0\
+            else default
+
+    def chr_lines_nums(self, scn_idx):
+        '''シーンの、登場人物のインデックスからセリフ数への dict を返す
+
+        セリフ数が「自動」なら、シーンの平均値とする
+        '''
+        scn_apprs = self.scns_apprs[scn_idx]
+        average_lines_num = self.average_lines_num(scn_apprs.values())
+        return {chr_idx: average_lines_num if lines_auto else lines_num
+            for chr_idx, (lines_num, lines_auto) in scn_apprs.items()}
+
+    def actr_lines_nums(self, scn_idx):
+        '''シーンの、役者のインデックスから演じる役のセリフ数の合計への dict を返す
+
+        配役のない登場人物は含まない
+        '''
+        actr_lines_nums = {}
+        for chr_idx, lines_num in self.chr_lines_nums(scn_idx).items():
+            actr_idx = self.cast_idxs[chr_idx]
+            if actr_idx >= 0:
+                actr_lines_nums[actr_idx] =\
+                    actr_lines_nums.get(actr_idx, 0) + lines_num
+        return actr_lines_nums
+
+    def actr_bits(self, scn_idx):
+        '''シーンに出ている役者のビットセットを返す
+        '''
+        bits = 0
+        for chr_idx in self.scns_apprs[scn_idx]:
+            if self.cast_idxs[chr_idx] >= 0:
+                bits |= 1 << self.cast_idxs[chr_idx]
+        return bits
+
+
+def scene_weights(appr_matrix):
+    '''シーンごとの、稽古可能性の計算に使う重みを得る
+
+    Parameters
+    ----------
+    appr_matrix : AppearanceMatrix
+        公演の出番の行列
+
+    Returns
+    -------
+    scns_weights : list
+        シーンごとの、以下の dict のリスト
+        actr_bits : 出ている役者のビットセット
+        chrs_num : 登場人物数
+        actrs_num : 役者数 (配役のない登場人物は、まとめて1人と数える)
+        lines_num : セリフ数の合計
+        actr_chrs_nums : 役者のインデックスから、演じる役の数への dict
+        actr_lines_nums : 役者のインデックスから、セリフ数の合計への dict
+    '''
+    scns_weights = []
+    for scn_idx, scn_apprs in enumerate(appr_matrix.scns_apprs):
+        # シーンのセリフ数 (自動なら平均値)
+        lines_num = sum(appr_matrix.chr_lines_nums(scn_idx).values())
+
+        # 役者ごとの出番
+        actrs_apprs = {}
+        for chr_idx, appr in scn_apprs.items():
+            actrs_apprs.setdefault(
+                appr_matrix.cast_idxs[chr_idx], []).append(appr)
+
+        actr_chrs_nums = {}
+        actr_lines_nums = {}
+        for actr_idx, actr_apprs in actrs_apprs.items():
+            if actr_idx < 0:
+                continue
+            actr_chrs_nums[actr_idx] = len(actr_apprs)
+            # 自動のセリフ数は、その役者の出番の平均値とする
+            actr_average = appr_matrix.average_lines_num(actr_apprs)
+            actr_lines_nums[actr_idx] = sum([actr_average if lines_auto
+                    else lines_num
+                for lines_num, lines_auto in actr_apprs])
+
+        scns_weights.append({
+            'actr_bits': appr_matrix.actr_bits(scn_idx),
+            'chrs_num': len(scn_apprs),
+            'actrs_num': len(actrs_apprs),
+            'lines_num': lines_num,
+            'actr_chrs_nums': actr_chrs_nums,
+            'actr_lines_nums': actr_lines_nums,
         })
-    
-    return scns_time_slots
+
+    return scns_weights
+
+
+def rehearsal_possibility(prod_id, rehearsals=None, scenes=None,
+        backend=None):
+    '''公演の全稽古・全シーンの稽古可能性を一括で得る
+
+    クエリの数は稽古やシーンの数によらず一定
+
+    Parameters
+    ----------
+    prod_id : int
+        公演の id
+    rehearsals : list
+        対象の Rehearsal のリスト. 省略すると公演の全稽古
+    scenes : list
+        対象の Scene のリスト. 省略すると公演の全シーン
+    backend : str
+        'python' なら時間スロットごとに、'numpy' なら分単位の出席の行列で計算する
+        省略すると settings.RHSL_PSBLTY_BACKEND (なければ 'python')
+
+    Returns
+    -------
+    psblty_in_chrs : list
+        稽古ごとの、シーンごとの登場人物ベースの稽古可能性
+    psblty_in_actrs : list
+        稽古ごとの、シーンごとの役者ベースの稽古可能性
+    psblty_in_lines : list
+        稽古ごとの、シーンごとのセリフ数ベースの稽古可能性
+    '''
+    if backend is None:
+        backend = getattr(settings, 'RHSL_PSBLTY_BACKEND', 'python')
+    if backend not in ('python', 'numpy'):
+        raise ValueError('Unknown backend: {}'.format(backend))
+    if backend == 'numpy' and np is None:
+        raise ImportError('numpy is required for the numpy backend')
+
+    if rehearsals is None:
+        rehearsals = Rehearsal.objects.filter(production__pk=prod_id)
+    if scenes is None:
+        scenes = Scene.objects.filter(production__pk=prod_id)
+    rehearsals = list(rehearsals)
+    scenes = list(scenes)
+
+    # シーンごとの重み
+    appr_matrix = AppearanceMatrix(prod_id, scenes=scenes)
+    actr_idxs = appr_matrix.actr_idxs
+    scns_weights = scene_weights(appr_matrix)
+
+    # 稽古ごとの参加時間
+    rhsls_atnds = {rhsl.id: [] for rhsl in rehearsals}
+    attendances = Attendance.objects.filter(
+        rehearsal__production__pk=prod_id).order_by('id')
+    for atnd in attendances:
+        if atnd.rehearsal_id in rhsls_atnds:
+            rhsls_atnds[atnd.rehearsal_id].append(atnd)
+
+    # 稽古ごとの、全役者の in/out 時刻のリスト
+    rhsls_borders = [
+        time_borders_for_rehearsal(rhsl, rhsls_atnds[rhsl.id], actr_idxs)
+        for rhsl in rehearsals]
+
+    if backend == 'numpy':
+        return _possibility_in_minute_grid(
+            rehearsals, scenes, len(actr_idxs), scns_weights, rhsls_borders)
+    return _possibility_in_time_slots(
+        rehearsals, scenes, scns_weights, rhsls_borders)
+
+
+def _possibility_in_time_slots(rehearsals, scenes, scns_weights,
+        rhsls_borders):
+    '''稽古可能性を、シーンごとの時間スロットを走査して計算する
+    '''
+    scn_actr_bits = [weights['actr_bits'] for weights in scns_weights]
+
+    psblty_in_chrs = []
+    psblty_in_actrs = []
+    psblty_in_lines = []
+    # 稽古ごと
+    for rhsl, time_borders in zip(rehearsals, rhsls_borders):
+        scns_slots = scene_time_slots(rhsl, time_borders, scn_actr_bits)
+
+        chrs_psblty = []
+        actrs_psblty = []
+        lines_psblty = []
+        # シーンごと
+        for scene, slots, weights in zip(scenes, scns_slots, scns_weights):
+            # シーンの長さ
+            # TODO: length_auto に対応すること
+            scn_len = scene.length
+
+            chrs_num = weights['chrs_num']
+            actrs_num = weights['actrs_num']
+            lines_num = weights['lines_num']
+
+            chrs_sum = actrs_sum = lines_sum = 0
+            # スロットごとの「可能性の指標」を加算していく
+            for from_time, to_time, attendee in slots:
+                slot_time = to_time - from_time
+                atnd_idxs = bits_to_idxs(attendee)
+                # 出席者の役数の合計
+                atnd_chrs_num = sum([weights['actr_chrs_nums'][actr_idx]
+                    for actr_idx in atnd_idxs])
+                # 出席者のセリフ数の合計
+                atnd_lines_num = sum([weights['actr_lines_nums'][actr_idx]
+                    for actr_idx in atnd_idxs])
+
+                # 可能性の指標 = 時間 * 出席する役者の役の数 / シーンの登場人物数 / シーンの長さ
+                if chrs_num:
+                    chrs_sum += slot_time * atnd_chrs_num / chrs_num / scn_len
+                # 可能性の指標 = 時間 * 出席する役者の数 / シーンに出ている役者の数 / シーンの長さ
+                if actrs_num:
+                    actrs_sum += slot_time * len(atnd_idxs) / actrs_num / scn_len
+                # 可能性の指標 = 時間 * 出席する役者のセリフ数 / シーンのセリフ数 / シーンの長さ
+                if lines_num:
+                    lines_sum += slot_time * atnd_lines_num / lines_num / scn_len
+
+            chrs_psblty.append(chrs_sum)
+            actrs_psblty.append(actrs_sum)
+            lines_psblty.append(lines_sum)
+
+        psblty_in_chrs.append(chrs_psblty)
+        psblty_in_actrs.append(actrs_psblty)
+        psblty_in_lines.append(lines_psblty)
+
+    return psblty_in_chrs, psblty_in_actrs, psblty_in_lines
+
+
+def presence_matrix(rehearsal, time_borders, actrs_num):
+    '''稽古の、役者 x 分の出席の行列を得る
+
+    Parameters
+    ----------
+    rehearsal : Rehearsal
+        対象の稽古
+    time_borders : list
+        time_borders_for_rehearsal() で得た in/out 時刻のリスト
+    actrs_num : int
+        役者の数 (行列の行数)
+
+    Returns
+    -------
+    presence : numpy.ndarray
+        稽古の開始時刻からの分を列とする bool の行列
+    '''
+    start_time = time_to_minutes(rehearsal.start_time)
+    minutes = max(time_to_minutes(rehearsal.end_time) - start_time, 0)
+    presence = np.zeros((actrs_num, minutes), dtype=bool)
+
+    # 役者ごとに、最後に in/out した時刻と、出席中かどうか
+    last_times = [start_time] * actrs_num
+    attending = [False] * actrs_num
+    for time, actr_idx, is_in in time_borders:
+        if attending[actr_idx]:
+            presence[actr_idx,
+                last_times[actr_idx] - start_time:time - start_time] = True
+        last_times[actr_idx] = time
+        attending[actr_idx] = is_in
+
+    # 稽古の終了時刻まで出席中の役者
+    for actr_idx in range(actrs_num):
+        if attending[actr_idx]:
+            presence[actr_idx, last_times[actr_idx] - start_time:] = True
+
+    return presence
+
+
+def _possibility_in_minute_grid(rehearsals, scenes, actrs_num, scns_weights,
+        rhsls_borders):
+    '''稽古可能性を、分単位の出席の行列とシーンの重みの積で計算する
+    '''
+    # シーン x 役者の重みの行列
+    chrs_weights = np.zeros((len(scenes), actrs_num))
+    actrs_weights = np.zeros((len(scenes), actrs_num))
+    lines_weights = np.zeros((len(scenes), actrs_num))
+    for scn_idx, weights in enumerate(scns_weights):
+        for actr_idx, chrs_num in weights['actr_chrs_nums'].items():
+            chrs_weights[scn_idx, actr_idx] = chrs_num
+            actrs_weights[scn_idx, actr_idx] = 1
+        for actr_idx, lines_num in weights['actr_lines_nums'].items():
+            lines_weights[scn_idx, actr_idx] = lines_num
+
+    # 稽古 x 役者の出席時間 (分)
+    atnd_minutes = np.zeros((len(rehearsals), actrs_num))
+    for rhsl_idx, (rhsl, time_borders) in enumerate(
+            zip(rehearsals, rhsls_borders)):
+        presence = presence_matrix(rhsl, time_borders, actrs_num)
+        atnd_minutes[rhsl_idx] = presence.sum(axis=1)
+
+    # シーンごとの分母 (シーンの人数など x シーンの長さ)
+    # TODO: length_auto に対応すること
+    scn_lens = np.array([scn.length for scn in scenes], dtype=float)
+
+    def psblty(scns_weights_matrix, key):
+        denominators = np.array(
+            [weights[key] for weights in scns_weights], dtype=float) * scn_lens
+        totals = atnd_minutes @ scns_weights_matrix.T
+        # 分母が 0 のシーンは 0 とする
+        return np.divide(totals, denominators,
+            out=np.zeros_like(totals), where=denominators != 0).tolist()
+
+    return psblty(chrs_weights, 'chrs_num'),\
+        psblty(actrs_weights, 'actrs_num'),\
+        psblty(lines_weights, 'lines_num')
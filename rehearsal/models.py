@@ -56,6 +56,10 @@ class Rehearsal(models.Model):
     class Meta:
         verbose_name = verbose_name_plural = '稽古のコマ'
         ordering = ['date', 'start_time']
+        indexes = [
+            models.Index(fields=['production', 'date', 'start_time'],
+                name='rehearsal_prod_date_idx'),
+        ]
     
     def __str__(self):
         # ex. '08/30,○○公民館,会議室1'
@@ -161,6 +165,10 @@ class Attendance(models.Model):
     
     class Meta:
         verbose_name = verbose_name_plural = '参加時間'
+        indexes = [
+            models.Index(fields=['rehearsal', 'actor'],
+                name='attendance_rhsl_actr_idx'),
+        ]
     
     def __str__(self):
         # ex. '08/30,三橋,14:00-18:30'
@@ -193,6 +201,10 @@ class Appearance(models.Model):
     
     class Meta:
         verbose_name = verbose_name_plural = '出番'
+        constraints = [
+            models.UniqueConstraint(fields=['scene', 'character'],
+                name='appearance_scene_chr_unique'),
+        ]
     
     def __str__(self):
         # ex. 'シーン1,沙悟浄'
@@ -243,14 +255,154 @@ class ScnComment(models.Model):
 
 class AtndChangeLog(models.Model):
     '''参加時間の変更履歴
+    
+    変更前・変更後の参加時間は、状態と時刻 (0:00 からの分数) で持ち、
+    表示する文字列は表示する時に作る
+    稽古や役者が削除されても表示と集計ができるように、稽古と役者の id は
+    残し、稽古の日付と役者の短縮名は記録した時の値を持つ
+    状態が NULL のレコードは以前の形式で、文字列を old_value, new_value に持つ
     '''
+    # 参加時間の状態
+    STATE_NONE = 0      # なし (追加前・削除後)
+    STATE_TIME = 1      # 時間帯
+    STATE_ALLDAY = 2    # 全日
+    STATE_ABSENT = 3    # 欠席
+    STATE_CHOICES = [
+        (STATE_NONE, 'なし'),
+        (STATE_TIME, '時間帯'),
+        (STATE_ALLDAY, '全日'),
+        (STATE_ABSENT, '欠席'),
+    ]
+    
     production = models.ForeignKey(Production, verbose_name='公演',
         on_delete=models.CASCADE)
     create_dt = models.DateTimeField('記録日時', auto_now_add=True)
-    old_value = models.CharField('変更前', max_length=50) # 理論的には最大22文字
-    new_value = models.CharField('変更後', max_length=50) # 理論的には最大22文字
+    # 以前の形式の文字列 (理論的には最大22文字)
+    old_value = models.CharField('変更前', max_length=50, blank=True)
+    new_value = models.CharField('変更後', max_length=50, blank=True)
     changed_by = models.CharField('変更者', max_length=150)
     changed_by_id = models.IntegerField('変更者ID')
+    # 絞り込み・集計用 (稽古や役者が削除されても、id は残す)
+    rehearsal = models.ForeignKey(Rehearsal, verbose_name='稽古のコマ',
+        on_delete=models.DO_NOTHING, db_constraint=False,
+        blank=True, null=True)
+    actor = models.ForeignKey(Actor, verbose_name='役者',
+        on_delete=models.DO_NOTHING, db_constraint=False,
+        blank=True, null=True)
+    # 表示用 (記録した時の値)
+    rehearsal_date = models.DateField('稽古の日付', blank=True, null=True)
+    actor_name = models.CharField('役者の短縮名', max_length=50, blank=True)
+    old_state = models.PositiveSmallIntegerField('変更前の状態',
+        choices=STATE_CHOICES, blank=True, null=True)
+    old_from_min = models.PositiveSmallIntegerField('変更前の From (分)',
+        blank=True, null=True)
+    old_to_min = models.PositiveSmallIntegerField('変更前の To (分)',
+        blank=True, null=True)
+    new_state = models.PositiveSmallIntegerField('変更後の状態',
+        choices=STATE_CHOICES, blank=True, null=True)
+    new_from_min = models.PositiveSmallIntegerField('変更後の From (分)',
+        blank=True, null=True)
+    new_to_min = models.PositiveSmallIntegerField('変更後の To (分)',
+        blank=True, null=True)
 
     class Meta:
         verbose_name = verbose_name_plural = '出欠の変更履歴'
+        indexes = [
+            models.Index(fields=['production', '-create_dt', '-id'],
+                name='atndchangelog_prod_dt_id_idx'),
+            models.Index(fields=['actor', '-create_dt', '-id'],
+                name='atndchangelog_actr_dt_idx'),
+            models.Index(fields=['production', 'changed_by_id', '-create_dt'],
+                name='atndchangelog_chgr_dt_idx'),
+        ]
+    
+    def __str__(self):
+        # ex. '08/30,三橋,14:00-18:30 → 08/30,三橋,欠席'
+        return '{} → {}'.format(self.old_str, self.new_str)
+    
+    def set_atnds(self, old_atnd, new_atnd):
+        '''変更前・変更後の参加時間をセットする
+        
+        Parameters
+        ----------
+        old_atnd : Attendance
+            変更前の参加時間. 追加した時は None
+        new_atnd : Attendance
+            変更後の参加時間. 削除した時は None
+        
+        稽古と役者は、先にセットしておくこと
+        '''
+        self.rehearsal_date = self.rehearsal.date
+        self.actor_name = self.actor.get_short_name()
+        self.old_state, self.old_from_min, self.old_to_min =\
+            atnd_state_and_mins(old_atnd)
+        self.new_state, self.new_from_min, self.new_to_min =\
+            atnd_state_and_mins(new_atnd)
+    
+    @property
+    def old_str(self):
+        '''変更前の参加時間の表示 (ex. '08/30,三橋,14:00-18:30')
+        '''
+        if self.old_state is None:
+            return self.old_value
+        return self.atnd_str(self.old_state, self.old_from_min, self.old_to_min)
+    
+    @property
+    def new_str(self):
+        '''変更後の参加時間の表示 (ex. '08/30,三橋,14:00-18:30')
+        '''
+        if self.new_state is None:
+            return self.new_value
+        return self.atnd_str(self.new_state, self.new_from_min, self.new_to_min)
+    
+    def atnd_str(self, state, from_min, to_min):
+        '''状態と時刻から、Attendance.__str__() と同じ形式の文字列を作る
+        '''
+        if state == self.STATE_NONE:
+            return ''
+        # 稽古や役者が分からなければ '?'
+        str = '{},{},'.format(
+            self.rehearsal_date.strftime('%m/%d')
+                if self.rehearsal_date else '?',
+            self.actor_name or '?')
+        if state == self.STATE_ABSENT:
+            str += '欠席'
+        elif state == self.STATE_ALLDAY:
+            str += '全日'
+        else:
+            str += '{}-{}'.format(mins_to_str_or_unknown(from_min),
+                mins_to_str_or_unknown(to_min))
+        return str
+
+
+def atnd_state_and_mins(atnd):
+    '''参加時間を、変更履歴に持つ状態と時刻 (0:00 からの分数) にする
+    
+    Returns
+    -------
+    state : int
+        AtndChangeLog.STATE_*
+    from_min : int
+        From の分数 (時間帯でなければ None)
+    to_min : int
+        To の分数 (時間帯でなければ None)
+    '''
+    if atnd is None:
+        return AtndChangeLog.STATE_NONE, None, None
+    if atnd.is_absent:
+        return AtndChangeLog.STATE_ABSENT, None, None
+    if atnd.is_allday:
+        return AtndChangeLog.STATE_ALLDAY, None, None
+    return (AtndChangeLog.STATE_TIME,
+        atnd.from_time.hour * 60 + atnd.from_time.minute
+            if atnd.from_time else None,
+        atnd.to_time.hour * 60 + atnd.to_time.minute
+            if atnd.to_time else None)
+
+
+def mins_to_str_or_unknown(mins):
+    '''0:00 からの分数を 'HH:MM' にする (None なら '??:??')
+    '''
+    if mins is None:
+        return '??:??'
+    return '{:02d}:{:02d}'.format(*divmod(mins, 60))
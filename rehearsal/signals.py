@@ -0,0 +1,71 @@
+import threading
+from django.db import transaction
+from django.db.models.signals import post_save, pre_delete
+from production.models import Production
+from .models import Facility, Place, Rehearsal, Scene, Actor, Character,\
+    Attendance, Appearance
+
+
+# 公演を親のレコードから引くモデルと、その親のフィールド名
+PARENT_FIELDS = {
+    Attendance: 'rehearsal',
+    Appearance: 'scene',
+    Place: 'facility',
+}
+
+# トランザクションの間 (スレッドごと) に溜めておく、
+# バージョンを進める公演の id と、親のレコードの公演の id
+_pending = threading.local()
+
+
+def prod_id_of(instance):
+    '''レコードが属する公演の id を返す
+
+    親のレコードから引く場合は、同じ親を何度も引かないように覚えておく
+    (削除で一緒に消える子のレコードごとに、クエリを出さないため)
+    '''
+    parent_name = PARENT_FIELDS.get(type(instance))
+    if parent_name is None:
+        return instance.production_id
+
+    # 親のインスタンスを読み込み済みなら、それを使う
+    field = instance._meta.get_field(parent_name)
+    if field.is_cached(instance):
+        return getattr(instance, parent_name).production_id
+
+    parent_prod_ids = _pending.__dict__.setdefault('parent_prod_ids', {})
+    key = (field.related_model, getattr(instance, field.attname))
+    if key not in parent_prod_ids:
+        parent_prod_ids[key] = field.related_model.objects\
+            .filter(pk=key[1]).values_list('production_id', flat=True)\
+            .first()
+    return parent_prod_ids[key]
+
+
+def update_data_version(sender, instance, **kwargs):
+    '''稽古のデータが変更されたら、公演のデータのバージョンを進める
+
+    トランザクションの中 (削除で子のレコードも消える場合など) では、
+    コミットした時に、公演ごとに1回だけ進める
+    '''
+    _pending.__dict__.setdefault('prod_ids', set()).add(prod_id_of(instance))
+    transaction.on_commit(flush_data_versions)
+
+
+def flush_data_versions():
+    '''溜めておいた公演のデータのバージョンを進める
+    '''
+    prod_ids = _pending.__dict__.get('prod_ids')
+    _pending.parent_prod_ids = {}
+    if prod_ids:
+        _pending.prod_ids = set()
+        Production.update_data_version(
+            *[prod_id for prod_id in prod_ids if prod_id is not None])
+
+
+# 出欠表、香盤表などの元になるモデル
+# 削除は、関連するレコードが残っている pre_delete で検知する
+for model in (Facility, Place, Rehearsal, Scene, Actor, Character,
+        Attendance, Appearance):
+    post_save.connect(update_data_version, sender=model)
+    pre_delete.connect(update_data_version, sender=model)
@@ -1,3 +1,664 @@
-from django.test import TestCase
+import gzip
+import io
+import json
+import os
+import tempfile
+import time as timer
+from datetime import date, time, timedelta
+from unittest import skipIf
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection, transaction
+from django.db.models import Count, Q
+from django.http import QueryDict
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from django.test.utils import CaptureQueriesContext
+from accounts.models import User
+from production.models import Production, ProdUser
+from rehearsal import signals
+from rehearsal.models import Facility, Place, Rehearsal, Scene, Actor,\
+    Character, Appearance, Attendance, AtndChangeLog
+from rehearsal.model_func import rehearsal_possibility, np
+from rehearsal.management.commands.prune_atnd_change_logs import\
+    Command as PruneCommand
+from rehearsal.views.appr_table import appr_table_data
+from rehearsal.views.atnd_table import atnd_table_data
+from rehearsal.views.rhsl_psblty import rhsl_psblty_data
+from rehearsal.views.view_func import cached_prod_data
+from rehearsal.views.views import log_cursor, parse_log_cursor
 
-# Create your tests here.
+
+def create_production(actrs_num=4, rhsls_num=3):
+    '''テスト用の公演を作る
+
+    役者ごとに登場人物を1人ずつ配役し、配役のない登場人物も1人作る
+    シーンには、役者の登場人物が順に出る (セリフ数を決めない出番を含む)
+    参加時間には、全日、欠席、重なる時間帯、稽古の時間外を含む
+    '''
+    production = Production.objects.create(name='テスト公演')
+
+    actors = [Actor.objects.create(production=production,
+        name='役者{}'.format(idx)) for idx in range(actrs_num)]
+    characters = [Character.objects.create(production=production,
+        name='人物{}'.format(idx), cast=actor, sortkey=idx)
+        for idx, actor in enumerate(actors)]
+    characters.append(Character.objects.create(production=production,
+        name='配役なし', sortkey=len(actors)))
+
+    scenes = []
+    for scn_idx in range(3):
+        scene = Scene.objects.create(production=production,
+            name='シーン{}'.format(scn_idx), sortkey=scn_idx,
+            length=scn_idx + 1)
+        scenes.append(scene)
+        for chr_idx, character in enumerate(characters):
+            if (chr_idx + scn_idx) % 3 == 0:
+                continue
+            Appearance.objects.create(scene=scene, character=character,
+                lines_num=chr_idx + 1, lines_auto=(chr_idx == scn_idx))
+
+    rehearsals = [Rehearsal.objects.create(production=production,
+        date=date(2021, 4, rhsl_idx + 1), start_time=time(13, 0),
+        end_time=time(17, 30)) for rhsl_idx in range(rhsls_num)]
+
+    for rhsl_idx, rehearsal in enumerate(rehearsals):
+        for actr_idx, actor in enumerate(actors):
+            kind = (actr_idx + rhsl_idx) % 5
+            if kind == 0:
+                Attendance.objects.create(rehearsal=rehearsal, actor=actor,
+                    is_allday=True)
+            elif kind == 1:
+                Attendance.objects.create(rehearsal=rehearsal, actor=actor,
+                    is_absent=True)
+            elif kind == 2:
+                # 重なる時間帯
+                Attendance.objects.create(rehearsal=rehearsal, actor=actor,
+                    from_time=time(13, 30), to_time=time(15, 0))
+                Attendance.objects.create(rehearsal=rehearsal, actor=actor,
+                    from_time=time(14, 15), to_time=time(16, 10))
+            elif kind == 3:
+                # 稽古の時間外にはみ出す
+                Attendance.objects.create(rehearsal=rehearsal, actor=actor,
+                    from_time=time(11, 0), to_time=time(14, 5))
+                Attendance.objects.create(rehearsal=rehearsal, actor=actor,
+                    from_time=time(17, 0), to_time=time(19, 0))
+            # kind == 4 は参加時間なし
+
+    return production
+
+
+def create_large_production(actrs_num, rhsls_num):
+    '''テスト用に、役者と稽古の組ごとに参加時間が1つある公演をまとめて作る
+    '''
+    production = Production.objects.create(name='大きな公演')
+    Actor.objects.bulk_create([Actor(production=production,
+        name='役者{:03d}'.format(idx)) for idx in range(actrs_num)])
+    Rehearsal.objects.bulk_create([Rehearsal(production=production,
+        date=date(2021, 1, 1) + timedelta(days=idx),
+        start_time=time(13, 0), end_time=time(17, 0))
+        for idx in range(rhsls_num)])
+    actors = list(Actor.objects.filter(production=production))
+    rehearsals = list(Rehearsal.objects.filter(production=production))
+    Attendance.objects.bulk_create([Attendance(rehearsal=rehearsal,
+        actor=actor, from_time=time(13, actr_idx % 60),
+        to_time=time(16, 0)) for rehearsal in rehearsals
+        for actr_idx, actor in enumerate(actors)])
+    return production
+
+
+def best_time(func, *args, repeat=3):
+    '''関数を何度か実行して、最短の実行時間 (秒) を返す
+    '''
+    times = []
+    for _ in range(repeat):
+        start = timer.perf_counter()
+        func(*args)
+        times.append(timer.perf_counter() - start)
+    return min(times)
+
+
+class DataVersionTest(TestCase):
+    '''稽古のデータが変更された時に、公演のデータのバージョンを進めることのテスト
+    '''
+    def setUp(self):
+        # 他のテストのトランザクションはコミットされないので、溜まった分を捨てる
+        signals._pending.__dict__.clear()
+        self.production = Production.objects.create(name='テスト公演')
+    
+    def data_version(self):
+        return Production.objects.values_list('data_version', flat=True)\
+            .get(pk=self.production.pk)
+    
+    def commit(self, func):
+        '''func をトランザクションの中で実行してコミットする
+        '''
+        with self.captureOnCommitCallbacks(execute=True):
+            with transaction.atomic():
+                func()
+    
+    def assert_bumps_once(self, func):
+        version = self.data_version()
+        self.commit(func)
+        self.assertEqual(self.data_version(), version + 1)
+    
+    def create_objs(self):
+        '''バージョンを進めるモデルのインスタンスを、親から順に作る (未保存)
+        '''
+        facility = Facility(production=self.production, name='施設')
+        place = Place(facility=facility, room_name='部屋')
+        rehearsal = Rehearsal(production=self.production, place=place,
+            date=date(2021, 4, 1), start_time=time(13, 0),
+            end_time=time(17, 0))
+        scene = Scene(production=self.production, name='シーン')
+        actor = Actor(production=self.production, name='役者')
+        character = Character(production=self.production, name='人物',
+            cast=actor)
+        attendance = Attendance(rehearsal=rehearsal, actor=actor,
+            is_allday=True)
+        appearance = Appearance(scene=scene, character=character)
+        return [facility, place, rehearsal, scene, actor, character,
+            attendance, appearance]
+    
+    def test_save_and_delete(self):
+        objs = self.create_objs()
+        for obj in objs:
+            with self.subTest(action='save', model=type(obj).__name__):
+                self.assert_bumps_once(obj.save)
+        
+        # 削除は、親のインスタンスを読み込んでいない状態で
+        for obj in reversed(objs):
+            obj = type(obj).objects.get(pk=obj.pk)
+            with self.subTest(action='delete', model=type(obj).__name__):
+                self.assert_bumps_once(obj.delete)
+    
+    def test_once_per_transaction(self):
+        objs = self.create_objs()
+        
+        def save_and_delete():
+            for obj in objs:
+                obj.save()
+            for obj in objs:
+                obj.save()
+            # 子のレコードも一緒に消える
+            Facility.objects.get(pk=objs[0].pk).delete()
+        
+        self.assert_bumps_once(save_and_delete)
+    
+    def test_cached_prod_data_rebuilds(self):
+        build_count = []
+        
+        def build_data():
+            build_count.append(1)
+            return {'actors': list(Actor.objects.filter(
+                production=self.production).values_list('name', flat=True))}
+        
+        cache.clear()
+        data = cached_prod_data(self.production.pk, 'test', build_data)
+        self.assertEqual(json.loads(data['actors']), [])
+        cached_prod_data(self.production.pk, 'test', build_data)
+        self.assertEqual(len(build_count), 1)
+        
+        self.commit(lambda: Actor.objects.create(production=self.production,
+            name='役者'))
+        data = cached_prod_data(self.production.pk, 'test', build_data)
+        self.assertEqual(json.loads(data['actors']), ['役者'])
+        self.assertEqual(len(build_count), 2)
+    
+    def test_stale_save_keeps_version(self):
+        stale = Production.objects.get(pk=self.production.pk)
+        self.commit(lambda: Actor.objects.create(production=self.production,
+            name='役者'))
+        self.assertEqual(self.data_version(), 1)
+        
+        # 古いインスタンスを保存しても、バージョンは戻らない
+        stale.name = '公演名の変更'
+        stale.save()
+        self.assertEqual(self.data_version(), 1)
+        self.assertEqual(Production.objects.get(pk=self.production.pk).name,
+            '公演名の変更')
+
+
+class RhslPsbltyBackendTest(TestCase):
+    '''稽古可能性の計算方法による違いがないことのテスト
+    '''
+    @classmethod
+    def setUpTestData(cls):
+        cls.production = create_production()
+
+    @skipIf(np is None, 'numpy is not installed')
+    def test_numpy_equals_python(self):
+        python_result = rehearsal_possibility(self.production.id,
+            backend='python')
+        numpy_result = rehearsal_possibility(self.production.id,
+            backend='numpy')
+
+        # 登場人物・役者・セリフ数ベースの、稽古ごと・シーンごとの値
+        self.assertEqual(len(python_result), len(numpy_result))
+        for python_psblty, numpy_psblty in zip(python_result, numpy_result):
+            self.assertEqual(len(python_psblty), len(numpy_psblty))
+            for python_rhsl, numpy_rhsl in zip(python_psblty, numpy_psblty):
+                self.assertEqual(len(python_rhsl), len(numpy_rhsl))
+                for python_value, numpy_value in zip(python_rhsl, numpy_rhsl):
+                    self.assertAlmostEqual(python_value, numpy_value)
+
+        # 0 ばかりの比較にならないように
+        self.assertTrue(any(any(rhsl) for rhsl in python_result[0]))
+
+
+class AtndTableScalingTest(TestCase):
+    '''出欠表のデータを作る時間が、参加時間の数に比例することのテスト
+    '''
+    def test_linear_in_attendances(self):
+        # 役者の数を変えずに、稽古 (と参加時間) の数を 16 倍にする
+        small = create_large_production(10, 20)
+        large = create_large_production(10, 320)
+        
+        small_time = best_time(atnd_table_data, small.id)
+        large_time = best_time(atnd_table_data, large.id)
+        
+        # 比例すれば 16 倍、稽古ごとに全参加時間を走査すれば 256 倍になる
+        self.assertLess(large_time, small_time * 48)
+        
+        # クエリの数は変わらない
+        with CaptureQueriesContext(connection) as small_queries:
+            atnd_table_data(small.id)
+        with self.assertNumQueries(len(small_queries)):
+            atnd_table_data(large.id)
+
+
+class AtndGraphQueriesTest(TestCase):
+    '''出欠グラフのクエリの数が、役者の数によらないことのテスト
+    '''
+    # セッションとユーザ (2)、稽古 (1)、公演ユーザ (1)、公演のバージョン (1)、
+    # 役者、シーン、登場人物、出番、参加時間 (5)
+    QUERIES_NUM = 10
+    
+    def setUp(self):
+        # 公演のデータのキャッシュを使わせない
+        cache.clear()
+        self.user = User.objects.create_user('tester', password='password')
+        self.client.force_login(self.user)
+    
+    def assert_graph_queries(self, actrs_num):
+        production = create_production(actrs_num=actrs_num)
+        ProdUser.objects.create(production=production, user=self.user,
+            is_owner=True)
+        rehearsal = Rehearsal.objects.filter(production=production).first()
+        
+        with self.assertNumQueries(self.QUERIES_NUM):
+            response = self.client.get(reverse('rehearsal:atnd_graph',
+                kwargs={'rhsl_id': rehearsal.id}))
+        self.assertEqual(response.status_code, 200)
+    
+    def test_5_actors(self):
+        self.assert_graph_queries(5)
+    
+    def test_40_actors(self):
+        self.assert_graph_queries(40)
+
+
+class ProdDataApiTest(TestCase):
+    '''公演のデータの API のテスト
+    '''
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user('tester', password='password')
+        self.client.force_login(self.user)
+        self.production = create_production()
+        ProdUser.objects.create(production=self.production, user=self.user,
+            is_owner=True)
+    
+    def get_json(self, url_name, **params):
+        response = self.client.get(reverse('rehearsal:' + url_name,
+            kwargs={'prod_id': self.production.id}), params)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'application/json')
+        return json.loads(response.content)
+    
+    def test_data(self):
+        for url_name, build_data in (('atnd_table_api', atnd_table_data),
+                ('appr_table_api', appr_table_data),
+                ('rhsl_psblty_api', rhsl_psblty_data)):
+            with self.subTest(url_name=url_name):
+                expected = json.loads(json.dumps(
+                    build_data(self.production.id)))
+                self.assertEqual(self.get_json(url_name), expected)
+                
+                # 項目を選ぶ (知らない項目は無視する)
+                key = next(iter(expected))
+                self.assertEqual(
+                    self.get_json(url_name, fields=key + ',unknown'),
+                    {key: expected[key]})
+    
+    def test_permission(self):
+        other_user = User.objects.create_user('other', password='password')
+        self.client.force_login(other_user)
+        for url_name in ('atnd_table_api', 'appr_table_api',
+                'rhsl_psblty_api', 'actr_atnds_api'):
+            response = self.client.get(reverse('rehearsal:' + url_name,
+                kwargs={'prod_id': self.production.id}))
+            self.assertEqual(response.status_code, 403, url_name)
+
+
+class AtndChangeLogTest(TestCase):
+    '''出欠の変更履歴の記録と表示のテスト
+    '''
+    def setUp(self):
+        self.production = create_production()
+        self.rehearsal = Rehearsal.objects.filter(
+            production=self.production).first()
+        self.actor = Actor.objects.filter(production=self.production).first()
+    
+    def create_log(self, old_atnd, new_atnd):
+        log = AtndChangeLog(production=self.production,
+            changed_by='tester', changed_by_id=1,
+            rehearsal=self.rehearsal, actor=self.actor)
+        log.set_atnds(old_atnd, new_atnd)
+        log.save()
+        return log
+    
+    def test_set_atnds(self):
+        old_atnd = Attendance(rehearsal=self.rehearsal, actor=self.actor,
+            from_time=time(13, 30), to_time=time(15, 0))
+        new_atnd = Attendance(rehearsal=self.rehearsal, actor=self.actor,
+            is_absent=True)
+        log = self.create_log(old_atnd, new_atnd)
+        
+        self.assertEqual((log.old_state, log.old_from_min, log.old_to_min),
+            (AtndChangeLog.STATE_TIME, 13 * 60 + 30, 15 * 60))
+        self.assertEqual((log.new_state, log.new_from_min, log.new_to_min),
+            (AtndChangeLog.STATE_ABSENT, None, None))
+        self.assertEqual(log.rehearsal_date, self.rehearsal.date)
+        self.assertEqual(log.actor_name, self.actor.get_short_name())
+        
+        log = self.create_log(None, Attendance(rehearsal=self.rehearsal,
+            actor=self.actor, is_allday=True))
+        self.assertEqual(log.old_state, AtndChangeLog.STATE_NONE)
+        self.assertEqual(log.new_state, AtndChangeLog.STATE_ALLDAY)
+    
+    def test_old_new_str(self):
+        # Attendance.__str__() と同じ形式
+        old_atnd = Attendance(rehearsal=self.rehearsal, actor=self.actor,
+            from_time=time(13, 30), to_time=time(15, 0))
+        new_atnd = Attendance(rehearsal=self.rehearsal, actor=self.actor,
+            from_time=time(14, 0))
+        log = AtndChangeLog.objects.get(
+            pk=self.create_log(old_atnd, new_atnd).pk)
+        self.assertEqual(log.old_str, str(old_atnd))
+        self.assertEqual(log.new_str, '04/01,役者0,14:00-??:??')
+        
+        log = self.create_log(None, Attendance(rehearsal=self.rehearsal,
+            actor=self.actor, is_allday=True))
+        self.assertEqual(log.old_str, '')
+        self.assertEqual(log.new_str, '04/01,役者0,全日')
+        
+        log = self.create_log(Attendance(rehearsal=self.rehearsal,
+            actor=self.actor, is_absent=True), None)
+        self.assertEqual(log.old_str, '04/01,役者0,欠席')
+        self.assertEqual(log.new_str, '')
+    
+    def test_legacy_rows(self):
+        # 状態が NULL のレコードは、記録した文字列を表示する
+        log = AtndChangeLog.objects.create(production=self.production,
+            old_value='08/30,三橋,14:00-18:30', new_value='08/30,三橋,欠席',
+            changed_by='tester', changed_by_id=1)
+        log = AtndChangeLog.objects.get(pk=log.pk)
+        self.assertEqual(log.old_str, '08/30,三橋,14:00-18:30')
+        self.assertEqual(log.new_str, '08/30,三橋,欠席')
+        self.assertEqual(str(log), '08/30,三橋,14:00-18:30 → 08/30,三橋,欠席')
+    
+    def test_survives_delete(self):
+        new_atnd = Attendance(rehearsal=self.rehearsal, actor=self.actor,
+            from_time=time(14, 0), to_time=time(18, 30))
+        log = self.create_log(None, new_atnd)
+        actr_id = self.actor.id
+        rhsl_id = self.rehearsal.id
+        
+        self.actor.delete()
+        self.rehearsal.delete()
+        
+        # id と表示は残る
+        log = AtndChangeLog.objects.get(pk=log.pk)
+        self.assertEqual((log.actor_id, log.rehearsal_id), (actr_id, rhsl_id))
+        self.assertEqual(log.new_str, '04/01,役者0,14:00-18:30')
+        
+        # 役者ごとに集計できる
+        counts = dict(AtndChangeLog.objects.filter(production=self.production)
+            .values_list('actor_id').annotate(Count('id')))
+        self.assertEqual(counts, {actr_id: 1})
+
+
+class AtndChangeListTest(TestCase):
+    '''出欠の変更履歴のページ送りと絞り込みのテスト
+    '''
+    def setUp(self):
+        self.user = User.objects.create_user('tester', password='password')
+        self.client.force_login(self.user)
+        self.production = create_production()
+        self.prod_user = ProdUser.objects.create(production=self.production,
+            user=self.user, is_owner=True)
+        self.url = reverse('rehearsal:atnd_change_list',
+            kwargs={'prod_id': self.production.id})
+    
+    def create_logs(self, logs_num):
+        AtndChangeLog.objects.bulk_create([AtndChangeLog(
+            production=self.production, changed_by='tester',
+            changed_by_id=self.prod_user.id) for _ in range(logs_num)])
+        return AtndChangeLog.objects.filter(production=self.production)
+    
+    def test_cursor_round_trip(self):
+        log = self.create_logs(1).get()
+        self.assertEqual(parse_log_cursor(log_cursor(log)),
+            (log.create_dt, log.id))
+    
+    def test_invalid_cursors(self):
+        for cursor in ('', '_', '1_', '_1', 'a_1', '1_a', '²_1', '1_²',
+                '99999999999999999999_1'):
+            self.assertIsNone(parse_log_cursor(cursor), cursor)
+    
+    def test_invalid_params(self):
+        # 正しくないパラメタは無視する
+        for params in ({'actor': '²'}, {'changer': '²'},
+                {'cursor': '99999999999999999999_1'}, {'date': '2021-13-01'}):
+            response = self.client.get(self.url, params)
+            self.assertEqual(response.status_code, 200, params)
+            self.assertTrue(response.context['is_first_page'])
+    
+    def test_pages_of_same_create_dt(self):
+        # 記録日時が同じでも、id の順に、漏れなく重ならずにページを送る
+        logs = self.create_logs(120)
+        logs.update(create_dt=logs.first().create_dt)
+        
+        log_ids = []
+        params = {}
+        while True:
+            response = self.client.get(self.url, params)
+            log_ids += [log.id for log in response.context['object_list']]
+            if 'next_page_query' not in response.context:
+                break
+            params = QueryDict(response.context['next_page_query'])
+        
+        self.assertEqual(log_ids, sorted(
+            logs.values_list('id', flat=True), reverse=True))
+
+
+@override_settings(ATND_CHANGE_LOG_KEEP_DAYS=None,
+    ATND_CHANGE_LOG_KEEP_ROWS=None)
+class PruneAtndChangeLogsTest(TestCase):
+    '''保存件数を超えた出欠の変更履歴の削除のテスト
+    '''
+    def setUp(self):
+        self.production = Production.objects.create(name='テスト公演')
+        AtndChangeLog.objects.bulk_create([AtndChangeLog(
+            production=self.production, changed_by='tester',
+            changed_by_id=1) for _ in range(10)])
+        
+        # 記録日時が同じものを、3件、4件、3件作る
+        self.log_ids = list(AtndChangeLog.objects.order_by('id')
+            .values_list('id', flat=True))
+        base_dt = AtndChangeLog.objects.first().create_dt
+        for idx, log_ids in enumerate((self.log_ids[:3], self.log_ids[3:7],
+                self.log_ids[7:])):
+            AtndChangeLog.objects.filter(id__in=log_ids).update(
+                create_dt=base_dt + timedelta(minutes=idx))
+    
+    def expired_ids(self, keep_rows):
+        self.production.log_keep_rows = keep_rows
+        logs = PruneCommand().expired_logs(self.production)
+        if logs is None:
+            return None
+        return sorted(logs.values_list('id', flat=True))
+    
+    def test_keep_rows(self):
+        # 新しい方から、記録日時と id の順に残す
+        # 境界が記録日時の同じものの中にあっても、id で分ける
+        self.assertEqual(self.expired_ids(5), self.log_ids[:5])
+        self.assertEqual(self.expired_ids(3), self.log_ids[:7])
+        self.assertEqual(self.expired_ids(0), self.log_ids)
+        self.assertEqual(self.expired_ids(10), [])
+        self.assertIsNone(self.expired_ids(None))
+    
+    def test_archive(self):
+        self.production.log_keep_rows = 4
+        self.production.save()
+        
+        with tempfile.TemporaryDirectory() as archive_dir:
+            call_command('prune_atnd_change_logs', batch_size=2,
+                archive_dir=archive_dir, stdout=io.StringIO())
+            
+            archived_ids = []
+            for file_name in os.listdir(archive_dir):
+                with gzip.open(os.path.join(archive_dir, file_name), 'rt',
+                        encoding='utf-8') as archive:
+                    archived_ids += [json.loads(line)['id']
+                        for line in archive]
+        
+        self.assertEqual(archived_ids, self.log_ids[:6])
+        self.assertEqual(list(AtndChangeLog.objects.order_by('id')
+            .values_list('id', flat=True)), self.log_ids[6:])
+
+
+class IndexUsageTest(TestCase):
+    '''ビューが出すクエリが、複合インデックスを使うことのテスト
+    
+    ビューへのリクエストで実際に出たクエリの実行計画を見る
+    '''
+    def setUp(self):
+        # 公演のデータのキャッシュを使わせない
+        cache.clear()
+        self.user = User.objects.create_user('tester', password='password')
+        self.client.force_login(self.user)
+        self.production = create_production()
+        ProdUser.objects.create(production=self.production, user=self.user,
+            is_owner=True)
+        self.rehearsal = Rehearsal.objects.filter(
+            production=self.production).first()
+        self.actor = Actor.objects.filter(production=self.production).first()
+    
+    def captured_sql(self, request, table, *columns):
+        '''リクエストで出たクエリのうち、テーブルを列で絞り込む SELECT を返す
+        
+        Parameters
+        ----------
+        request : function
+            リクエストを送る関数
+        table : str
+            テーブル名
+        columns : str
+            WHERE 句にあるべき列名
+        '''
+        with CaptureQueriesContext(connection) as queries:
+            request()
+        quote = connection.ops.quote_name
+        for query in queries:
+            sql = query['sql']
+            select, _, where = sql.partition(' WHERE ')
+            if select.startswith('SELECT') and (
+                    ' FROM {} '.format(quote(table)) in select + ' ') and all(
+                    quote(column) in where for column in columns):
+                return sql
+        self.fail('{} を {} で絞り込むクエリがありません'.format(
+            table, ', '.join(columns)))
+    
+    def assert_uses_index(self, sql, index_name):
+        '''クエリの実行計画に、インデックスの名前があることを確かめる
+        '''
+        with connection.cursor() as cursor:
+            # PostgreSQL は小さいテーブルを全件走査するので、させない
+            if connection.vendor == 'postgresql':
+                cursor.execute('SET enable_seqscan = off')
+            cursor.execute(
+                connection.ops.explain_query_prefix() + ' ' + sql)
+            plan = ' '.join(str(value) for row in cursor.fetchall()
+                for value in row)
+            if connection.vendor == 'postgresql':
+                cursor.execute('SET enable_seqscan = on')
+        self.assertIn(index_name, plan)
+    
+    def unique_index_name(self, table, constraint_name):
+        '''一意制約のインデックスの名前
+        
+        SQLite では、テーブルの定義に入った制約に自動で名前がつく
+        '''
+        if connection.vendor == 'sqlite':
+            return 'sqlite_autoindex_{}_'.format(table)
+        return constraint_name
+    
+    def test_attendance_of_rehearsal_and_actor(self):
+        # 参加時間の追加で、同じ稽古・役者の参加時間を探す
+        sql = self.captured_sql(lambda: self.client.post(
+            reverse('rehearsal:atnd_create', kwargs={
+                'rhsl_id': self.rehearsal.id, 'actr_id': self.actor.id,
+                'from': 'rhsl'}),
+            {'from_time': '19:00', 'to_time': '20:00'}),
+            'rehearsal_attendance', 'rehearsal_id', 'actor_id')
+        self.assert_uses_index(sql, 'attendance_rhsl_actr_idx')
+    
+    def test_appearance_of_scene_and_character(self):
+        # 出番の追加で、同じシーン・登場人物の出番を探す
+        appr = Appearance.objects.filter(
+            scene__production=self.production).first()
+        sql = self.captured_sql(lambda: self.client.post(
+            reverse('rehearsal:scn_appr_create',
+                kwargs={'scn_id': appr.scene_id}),
+            {'character': appr.character_id, 'lines_num': 1}),
+            'rehearsal_appearance', 'scene_id', 'character_id')
+        self.assert_uses_index(sql, self.unique_index_name(
+            'rehearsal_appearance', 'appearance_scene_chr_unique'))
+    
+    def test_rehearsals_of_production(self):
+        # 出欠表の稽古のリスト (日付と開始時刻の順)
+        sql = self.captured_sql(lambda: self.client.get(
+            reverse('rehearsal:atnd_table',
+                kwargs={'prod_id': self.production.id})),
+            'rehearsal_rehearsal', 'production_id')
+        self.assert_uses_index(sql, 'rehearsal_prod_date_idx')
+    
+    def test_prod_user_of_production_and_user(self):
+        # 参加していない公演では、公演とユーザで公演ユーザを探す
+        other_production = Production.objects.create(name='他の公演')
+        sql = self.captured_sql(lambda: self.client.get(
+            reverse('rehearsal:atnd_table',
+                kwargs={'prod_id': other_production.id})),
+            'production_produser', 'production_id', 'user_id')
+        self.assert_uses_index(sql, self.unique_index_name(
+            'production_produser', 'produser_prod_user_unique'))
+    
+    def test_change_log_pages(self):
+        # 出欠の変更履歴の、カーソルより後のページ
+        sql = self.captured_sql(lambda: self.client.get(
+            reverse('rehearsal:atnd_change_list',
+                kwargs={'prod_id': self.production.id}),
+            {'cursor': '1617235200000000_100'}),
+            'rehearsal_atndchangelog', 'production_id', 'create_dt')
+        self.assert_uses_index(sql, 'atndchangelog_prod_dt_id_idx')
+    
+    def test_change_log_of_actor(self):
+        # 役者で絞り込んだ出欠の変更履歴
+        sql = self.captured_sql(lambda: self.client.get(
+            reverse('rehearsal:atnd_change_list',
+                kwargs={'prod_id': self.production.id}),
+            {'actor': self.actor.id}),
+            'rehearsal_atndchangelog', 'actor_id')
+        self.assert_uses_index(sql, 'atndchangelog_actr_dt_idx')
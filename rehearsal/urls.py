@@ -184,6 +184,27 @@ urlpatterns = [
     path('rhsl_psblty/<int:prod_id>/', views.RhslPossibility.as_view(),
         name='rhsl_psblty'),
 
+    # ----------------------------------------------------------------
+    # データの API (JSON)
+
+    # /rhsl/api/v1/appr_table/1/ -> Appearance table data for Production #1
+    path('api/v1/appr_table/<int:prod_id>/', views.ApprTableApi.as_view(),
+        name='appr_table_api'),
+    # /rhsl/api/v1/atnd_table/1/ -> Attendance table data for Production #1
+    path('api/v1/atnd_table/<int:prod_id>/', views.AtndTableApi.as_view(),
+        name='atnd_table_api'),
+    # /rhsl/api/v1/atnd_table/1/actr_atnds/
+    #   -> Compact attendances of each actor for Production #1
+    path('api/v1/atnd_table/<int:prod_id>/actr_atnds/',
+        views.ActrAtndsApi.as_view(), name='actr_atnds_api'),
+    # /rhsl/api/v1/atnd_graph/1/ -> Attendance graph data for Rehearsal #1
+    path('api/v1/atnd_graph/<int:rhsl_id>/', views.AtndGraphApi.as_view(),
+        name='atnd_graph_api'),
+    # /rhsl/api/v1/rhsl_psblty/1/
+    #   -> Rehearsal possibility data for Production #1
+    path('api/v1/rhsl_psblty/<int:prod_id>/',
+        views.RhslPossibilityApi.as_view(), name='rhsl_psblty_api'),
+
     # ----------------------------------------------------------------
     # 出欠変更履歴
 
@@ -3,3 +3,4 @@ from .appr_table import *
 from .atnd_table import *
 from .atnd_graph import *
 from .rhsl_psblty import *
+from .data_api import *
@@ -1,12 +1,12 @@
-import json
 from django.contrib.auth.mixins import LoginRequiredMixin
 from django.views.generic import TemplateView
 from django.core.exceptions import PermissionDenied
-from rehearsal.models import Scene, Character, Actor, Appearance
+from rehearsal.model_func import AppearanceMatrix
 from production.view_func import *
+from .view_func import *
 
 
-class ApprTable(LoginRequiredMixin, TemplateView):
+class ApprTable(LoginRequiredMixin, ProdDataConditionalMixin, TemplateView):
     '''香盤表のビュー
     '''
     template_name = 'rehearsal/appearance_table.html'
@@ -30,74 +30,54 @@ class ApprTable(LoginRequiredMixin, TemplateView):
         prod_id = self.kwargs['prod_id']
         context['prod_id'] = prod_id
         
-        # シーン名リスト
-        scenes = Scene.objects.filter(production__pk=prod_id)
-        context['scenes'] = json.dumps([scn.name for scn in scenes])
-        
-        # 登場人物名リスト
-        characters = Character.objects.filter(production__pk=prod_id)
-        context['characters'] = json.dumps([chr.get_short_name() for chr in characters])
-        
-        # 役者名リスト
-        actors = Actor.objects.filter(production__pk=prod_id)
-        context['cast'] = json.dumps([actr.get_short_name() for actr in actors])
-        
-        # 各シーンの登場人物ごとの出番 (セリフ数) のリスト
-        appearances = Appearance.objects.filter(scene__production__pk=prod_id)
-        scenes_chr_apprs = []
-        for scene in scenes:
-            # シーン単品での出番のリスト
-            scene_apprs = [appr for appr in appearances if appr.scene == scene]
-            # 有効なセリフ数の平均値
-            avrg_lines_num = Appearance.average_lines_num(scene_apprs)
-            # そのシーンの、登場人物全員分のセリフ数のリスト
-            chr_apprs = []
-            for character in characters:
-                apprs = [appr for appr in scene_apprs if appr.character == character]
-                if len(apprs) > 0:
-                    # セリフ数 (自動なら平均値)
-                    chr_apprs.append(
-                        avrg_lines_num if apprs[0].lines_auto else apprs[0].lines_num)
-                else:
-                    # 出番がないなら -1 を入れる
-                    chr_apprs.append(-1)
-            scenes_chr_apprs.append(chr_apprs)
-        
-        context['chr_apprs'] = json.dumps(scenes_chr_apprs)
-        
-        # 各シーンの役者の出番 (セリフ数) のリスト
-        cast_for_chrs = []
-        # まず、各登場人物の配役が actors の何番目にあるかのリストを作る
-        for character in characters:
-            if character.cast in actors:
-                actr_idx = list(actors).index(character.cast)
-            else:
-                # 配役がなければ -1
-                actr_idx = -1
-            cast_for_chrs.append(actr_idx)
-        
-        scenes_cast_apprs = []
-        # シーンごとに見ていく
-        for chr_apprs in scenes_chr_apprs:
-            actr_apprs = []
-            # 役者ごとに演じる人物のセリフ数を足していく
-            for actr_idx, actr in enumerate(actors):
-                lines_num = 0
-                appearing = False
-                # 登場人物ごとにキャストのインデックスを見ていく
-                for chr_idx, cast in enumerate(cast_for_chrs):
-                    # インデックスが外側のループと等しければ、そのセリフ数を足す
-                    if cast == actr_idx:
-                        if chr_apprs[chr_idx] >= 0:
-                            lines_num += chr_apprs[chr_idx]
-                            appearing = True
-                if appearing:
-                    actr_apprs.append(lines_num)
-                # その役者の出番がなかったら、-1 を入れる
-                else:
-                    actr_apprs.append(-1)
-            scenes_cast_apprs.append(actr_apprs)
-        
-        context['cast_apprs'] = json.dumps(scenes_cast_apprs)
+        # 香盤表のデータ (データが変更されていなければキャッシュから)
+        context.update(cached_prod_data(prod_id, 'appr_table',
+            appr_table_data, prod_id, version=self.data_version))
         
         return context
+
+
+def appr_table_data(prod_id):
+    '''香盤表のデータを作る
+    
+    Returns
+    -------
+    data : dict
+        テンプレートに JSON で渡す値の dict
+    '''
+    data = {}
+    
+    # シーン x 登場人物の出番
+    appr_matrix = AppearanceMatrix(prod_id)
+    
+    # シーン名リスト
+    data['scenes'] = [scn.name for scn in appr_matrix.scenes]
+    
+    # 登場人物名リスト
+    data['characters'] = [
+        chr.get_short_name() for chr in appr_matrix.characters]
+    
+    # 役者名リスト
+    data['cast'] = [actr.get_short_name() for actr in appr_matrix.actors]
+    
+    # 各シーンの登場人物ごとの出番 (セリフ数) のリスト
+    # 出番がないなら -1 を入れる
+    scenes_chr_apprs = []
+    for scn_idx in range(len(appr_matrix.scenes)):
+        chr_lines_nums = appr_matrix.chr_lines_nums(scn_idx)
+        scenes_chr_apprs.append([chr_lines_nums.get(chr_idx, -1)
+            for chr_idx in range(len(appr_matrix.characters))])
+    
+    data['chr_apprs'] = scenes_chr_apprs
+    
+    # 各シーンの役者の出番 (演じる人物のセリフ数の合計) のリスト
+    # その役者の出番がなかったら、-1 を入れる
+    scenes_cast_apprs = []
+    for scn_idx in range(len(appr_matrix.scenes)):
+        actr_lines_nums = appr_matrix.actr_lines_nums(scn_idx)
+        scenes_cast_apprs.append([actr_lines_nums.get(actr_idx, -1)
+            for actr_idx in range(len(appr_matrix.actors))])
+    
+    data['cast_apprs'] = scenes_cast_apprs
+    
+    return data
@@ -1,13 +1,19 @@
 import json
-from operator import attrgetter
 from django.contrib.auth.mixins import LoginRequiredMixin
 from django.views.generic import TemplateView
 from django.core.exceptions import PermissionDenied
-from rehearsal.models import Rehearsal, Actor, Attendance, Character, Scene, Appearance
+from rehearsal.models import Rehearsal, Actor, Attendance
+from rehearsal.model_func import AppearanceMatrix, time_to_minutes
 from production.view_func import *
+from .view_func import *
 
 
-class AtndTable(LoginRequiredMixin, TemplateView):
+# コンパクトな出欠データで、時刻の代わりに入れる値
+ATND_ALLDAY = -1
+ATND_ABSENT = -2
+
+
+class AtndTable(LoginRequiredMixin, ProdDataConditionalMixin, TemplateView):
     '''出欠表のビュー
     '''
     template_name = 'rehearsal/attendance_table.html'
@@ -31,100 +37,137 @@ class AtndTable(LoginRequiredMixin, TemplateView):
         prod_id = self.kwargs['prod_id']
         context['prod_id'] = prod_id
         
-        # 稽古リスト
-        rehearsals = Rehearsal.objects.filter(production__pk=prod_id)
-        rhsl_list = [{
-            'id': rhsl.id,
-            'place': str(rhsl.place),
-            'date': rhsl.date.strftime('%Y-%m-%d'),
-            'start_time': rhsl.start_time.strftime('%H:%M'),
-            'end_time': rhsl.end_time.strftime('%H:%M')
-        } for rhsl in rehearsals]
-        context['rhsls'] = json.dumps(rhsl_list)
+        # 出欠表のデータ (データが変更されていなければキャッシュから)
+        context.update(cached_prod_data(prod_id, 'atnd_table',
+            atnd_table_data, prod_id, version=self.data_version))
         
-        # 役者リスト
-        actr_list = list(
-            Actor.objects.filter(production__pk=prod_id).order_by('name'))
+        return context
 
-        actrs = [{
-            'name': actr.name,
-            'short_name': actr.get_short_name()
-        } for actr in actr_list]
-        
-        context['actrs'] = json.dumps(actrs)
-        
-        # 役者ごとの出欠の、稽古リストに対応するリスト (3次元配列)
-        attendances = Attendance.objects.filter(actor__production__pk=prod_id)
-        actrs_rhsl_atnds = []
-        for actor in actr_list:
-            # その役者の出欠
-            actor_atnds = [atnd for atnd in attendances if atnd.actor == actor]
-            rhsl_attnds = []
-            for rehearsal in rehearsals:
-                # その稽古の出欠
-                slots = sorted(
-                    [atnd for atnd in actor_atnds if atnd.rehearsal == rehearsal],
-                    key=attrgetter('from_time')
-                )
-                atnds = []
-                for slot in slots:
-                    atnds.append(
-                        # 全日の場合
-                        '*' if slot.is_allday
-                        # 欠席の場合
-                        else '-' if slot.is_absent
-                        # さもなくば時間帯
-                        else slot.from_time.strftime('%H:%M') + '-'
-                            + slot.to_time.strftime('%H:%M')
-                    )
-                rhsl_attnds.append(atnds)
-            actrs_rhsl_atnds.append(rhsl_attnds)
-        
-        context['actr_atnds'] = json.dumps(actrs_rhsl_atnds)
-        
-        # 登場人物のリスト
-        characters = Character.objects.filter(production__pk=prod_id)
-        chrs = []
-        for character in characters:
-            # 配役が actr_list の何番目かを取得
-            if character.cast in actr_list:
-                actr_idx = actr_list.index(character.cast)
-            else:
-                # 配役がなければ -1
-                actr_idx = -1
-            chrs.append({
-                'name': character.name,
-                'short_name': character.short_name,
-                'cast_idx': actr_idx
-            })
-        
-        context['chrs'] = json.dumps(chrs)
-        
-        # シーン名リスト
-        scenes = Scene.objects.filter(production__pk=prod_id)
-        context['scenes'] = json.dumps([scn.name for scn in scenes])
 
-        # シーンごとの登場人物とセリフ数のリスト
-        appearances = Appearance.objects.filter(scene__production__pk=prod_id)
-        scenes_chr_apprs = []
-        for scene in scenes:
-            # シーン単品での出番のリスト
-            scene_apprs = [appr for appr in appearances if appr.scene == scene]
-            # 有効なセリフ数の平均値
-            avrg_lines_mun = Appearance.average_lines_num(scene_apprs)
-            # そのシーンに出ている人物のセリフ数のリスト
-            chr_apprs = []
-            for chr_idx, character in enumerate(characters):
-                apprs = [appr for appr in scene_apprs if appr.character == character]
-                if len(apprs) > 0:
-                    # セリフ数 (自動なら平均値)
-                    lines_num = avrg_lines_mun if apprs[0].lines_auto else apprs[0].lines_num
-                    chr_apprs.append({
-                        'chr_idx': chr_idx,
-                        'lines_num': lines_num
-                    })
-            scenes_chr_apprs.append(chr_apprs)
-        
-        context['scenes_chr_apprs'] = json.dumps(scenes_chr_apprs)
-        
-        return context
+def atnd_table_data(prod_id):
+    '''出欠表のデータを作る
+    
+    Returns
+    -------
+    data : dict
+        テンプレートに JSON で渡す値の dict
+    '''
+    data = {}
+    
+    # 稽古リスト
+    rehearsals = list(Rehearsal.objects.filter(production__pk=prod_id)
+        .select_related('place__facility'))
+    rhsl_list = [{
+        'id': rhsl.id,
+        'place': str(rhsl.place),
+        'date': rhsl.date.strftime('%Y-%m-%d'),
+        'start_time': rhsl.start_time.strftime('%H:%M'),
+        'end_time': rhsl.end_time.strftime('%H:%M')
+    } for rhsl in rehearsals]
+    data['rhsls'] = rhsl_list
+    
+    # 役者リスト
+    actr_list = list(
+        Actor.objects.filter(production__pk=prod_id).order_by('name'))
+
+    actrs = [{
+        'name': actr.name,
+        'short_name': actr.get_short_name()
+    } for actr in actr_list]
+    
+    data['actrs'] = actrs
+    
+    # 役者と稽古の組ごとの出欠 (開始時刻順)
+    atnds_index = {}
+    attendances = Attendance.objects.filter(actor__production__pk=prod_id)\
+        .order_by('from_time', 'id').values_list('actor_id', 'rehearsal_id',
+            'from_time', 'to_time', 'is_allday', 'is_absent')
+    for actr_id, rhsl_id, from_time, to_time, is_allday, is_absent\
+            in attendances:
+        atnds_index.setdefault((actr_id, rhsl_id), []).append(
+            # 全日の場合
+            '*' if is_allday
+            # 欠席の場合
+            else '-' if is_absent
+            # さもなくば時間帯
+            else from_time.strftime('%H:%M') + '-' + to_time.strftime('%H:%M')
+        )
+    
+    # 役者ごとの出欠の、稽古リストに対応するリスト (3次元配列)
+    data['actr_atnds'] = [
+        [atnds_index.get((actor.id, rehearsal.id), [])
+            for rehearsal in rehearsals]
+        for actor in actr_list]
+    
+    # シーン x 登場人物の出番
+    appr_matrix = AppearanceMatrix(prod_id, actors=actr_list)
+    
+    # 登場人物のリスト
+    data['chrs'] = [{
+        'name': character.name,
+        'short_name': character.short_name,
+        # 配役が actr_list の何番目か (配役がなければ -1)
+        'cast_idx': cast_idx
+    } for character, cast_idx
+        in zip(appr_matrix.characters, appr_matrix.cast_idxs)]
+    
+    # シーン名リスト
+    data['scenes'] = [scn.name for scn in appr_matrix.scenes]
+
+    # シーンごとの登場人物とセリフ数のリスト
+    data['scenes_chr_apprs'] = [[{
+        'chr_idx': chr_idx,
+        'lines_num': lines_num
+    } for chr_idx, lines_num
+        in sorted(appr_matrix.chr_lines_nums(scn_idx).items())]
+        for scn_idx in range(len(appr_matrix.scenes))]
+    
+    return data
+
+
+def compact_actr_atnds_chunks(prod_id):
+    '''役者ごとの出欠を、コンパクトな JSON にして少しずつ返す
+    
+    稽古と役者は id のリストにして、出欠ではそのインデックスを使う
+    1人の役者の出欠は [稽古のインデックス, 開始 (分), 終了 (分), ...] の
+    平らなリストで、全日なら開始・終了を ATND_ALLDAY に、
+    欠席なら ATND_ABSENT にする
+    
+    Yields
+    ------
+    chunk : str
+        JSON 文字列の断片 (役者1人ずつ)
+    '''
+    rhsl_ids = list(Rehearsal.objects.filter(production__pk=prod_id)
+        .values_list('id', flat=True))
+    actr_ids = list(Actor.objects.filter(production__pk=prod_id)
+        .order_by('name', 'id').values_list('id', flat=True))
+    rhsl_idxs = {rhsl_id: idx for idx, rhsl_id in enumerate(rhsl_ids)}
+    
+    yield '{{"allday": {}, "absent": {}, "rhsl_ids": {}, "actr_ids": {}, '\
+        '"actr_atnds": ['.format(ATND_ALLDAY, ATND_ABSENT,
+            json.dumps(rhsl_ids), json.dumps(actr_ids))
+    
+    # 役者リストと同じ順に、出欠を読みながら書き出す
+    attendances = Attendance.objects.filter(actor__production__pk=prod_id)\
+        .order_by('actor__name', 'actor_id', 'from_time', 'id')\
+        .values_list('actor_id', 'rehearsal_id',
+            'from_time', 'to_time', 'is_allday', 'is_absent').iterator()
+    atnd = next(attendances, None)
+    for actr_idx, actr_id in enumerate(actr_ids):
+        row = []
+        while atnd is not None and atnd[0] == actr_id:
+            _, rhsl_id, from_time, to_time, is_allday, is_absent = atnd
+            if rhsl_id in rhsl_idxs:
+                if is_allday:
+                    row.extend((rhsl_idxs[rhsl_id], ATND_ALLDAY, ATND_ALLDAY))
+                elif is_absent:
+                    row.extend((rhsl_idxs[rhsl_id], ATND_ABSENT, ATND_ABSENT))
+                else:
+                    row.extend((rhsl_idxs[rhsl_id],
+                        time_to_minutes(from_time), time_to_minutes(to_time)))
+            atnd = next(attendances, None)
+        yield (', ' if actr_idx > 0 else '')\
+            + json.dumps(row, separators=(',', ':'))
+    
+    yield ']}'
@@ -0,0 +1,154 @@
+import json
+from django.contrib.auth.mixins import LoginRequiredMixin
+from django.views.generic import View
+from django.views.decorators.gzip import gzip_page
+from django.utils.decorators import method_decorator
+from django.http import Http404, HttpResponse, StreamingHttpResponse
+from django.core.exceptions import PermissionDenied
+from rehearsal.models import Rehearsal
+from production.view_func import *
+from .view_func import *
+from .appr_table import appr_table_data
+from .atnd_table import atnd_table_data, compact_actr_atnds_chunks
+from .atnd_graph import atnd_graph_data
+from .rhsl_psblty import rhsl_psblty_data
+
+
+@method_decorator(gzip_page, name='dispatch')
+class JsonDataView(View):
+    '''JSON 文字列の dict を、1つの JSON オブジェクトとして返すビュー
+    
+    返す値を JSON 文字列にした dict は、サブクラスの get_json_data() で作る
+    クエリ文字列の fields (カンマ区切り) で、返す項目を選べる
+    '''
+    def get(self, request, *args, **kwargs):
+        '''表示時のリクエストを受けたハンドラ
+        '''
+        data = self.get_json_data()
+        
+        # 項目の選択 (知らない項目は無視する)
+        fields = request.GET.get('fields')
+        if fields:
+            keys = [key for key in fields.split(',') if key in data]
+        else:
+            keys = list(data.keys())
+        
+        # 値は JSON 文字列なので、そのまま繋げる
+        content = '{' + ', '.join(
+            '{}: {}'.format(json.dumps(key), data[key]) for key in keys) + '}'
+        
+        return HttpResponse(content, content_type='application/json')
+
+
+@method_decorator(gzip_page, name='dispatch')
+class StreamingJsonView(View):
+    '''JSON を少しずつ作りながら返すビュー
+    
+    JSON 文字列の断片を返すイテレータは、サブクラスの get_json_chunks() で作る
+    '''
+    def get(self, request, *args, **kwargs):
+        '''表示時のリクエストを受けたハンドラ
+        '''
+        return StreamingHttpResponse(self.get_json_chunks(),
+            content_type='application/json')
+
+
+class ProdDataApi(LoginRequiredMixin, ProdDataConditionalMixin, JsonDataView):
+    '''公演のデータを JSON で返すビューの Base class
+    
+    サブクラスでは、キャッシュするデータの名前 (data_name) と、
+    公演の id を渡すとデータを作る関数 (build_data) を指定する
+    '''
+    data_name = None
+    build_data = None
+    
+    def get(self, request, *args, **kwargs):
+        '''表示時のリクエストを受けたハンドラ
+        '''
+        # アクセス情報から公演ユーザを取得しアクセス権を検査する
+        prod_user = accessing_prod_user(self)
+        if not prod_user:
+            raise PermissionDenied
+        
+        return super().get(request, *args, **kwargs)
+    
+    def get_json_data(self):
+        '''返す値を JSON 文字列にした dict を返す
+        '''
+        prod_id = self.kwargs['prod_id']
+        return cached_prod_data(prod_id, self.data_name,
+            self.build_data, prod_id, version=self.data_version)
+
+
+class AtndTableApi(ProdDataApi):
+    '''出欠表のデータの API
+    '''
+    data_name = 'atnd_table'
+    build_data = staticmethod(atnd_table_data)
+
+
+class ApprTableApi(ProdDataApi):
+    '''香盤表のデータの API
+    '''
+    data_name = 'appr_table'
+    build_data = staticmethod(appr_table_data)
+
+
+class RhslPossibilityApi(ProdDataApi):
+    '''稽古可能性のデータの API
+    '''
+    data_name = 'rhsl_psblty'
+    build_data = staticmethod(rhsl_psblty_data)
+
+
+class ActrAtndsApi(LoginRequiredMixin, ProdDataConditionalMixin,
+        StreamingJsonView):
+    '''役者ごとの出欠を、コンパクトな形式で返す API
+    '''
+    def get(self, request, *args, **kwargs):
+        '''表示時のリクエストを受けたハンドラ
+        '''
+        # アクセス情報から公演ユーザを取得しアクセス権を検査する
+        prod_user = accessing_prod_user(self)
+        if not prod_user:
+            raise PermissionDenied
+        
+        return super().get(request, *args, **kwargs)
+    
+    def get_json_chunks(self):
+        return compact_actr_atnds_chunks(self.kwargs['prod_id'])
+
+
+class AtndGraphApi(LoginRequiredMixin, ProdDataConditionalMixin, JsonDataView):
+    '''出欠グラフのデータの API
+    '''
+    def get(self, request, *args, **kwargs):
+        '''表示時のリクエストを受けたハンドラ
+        '''
+        # URLconf から、Rehearsal を取得し、属性として持っておく
+        rehearsals = Rehearsal.objects.filter(pk=self.kwargs['rhsl_id'])\
+            .select_related('production')
+        if len(rehearsals) < 1:
+            raise Http404
+        self.rehearsal = rehearsals[0]
+        
+        # アクセス情報から公演ユーザを取得しアクセス権を検査する
+        prod_user = accessing_prod_user(self, self.rehearsal.production_id)
+        if not prod_user:
+            raise PermissionDenied
+        
+        return super().get(request, *args, **kwargs)
+    
+    def get_data_etag(self):
+        '''ETag を作る
+        '''
+        prod_id = self.rehearsal.production_id
+        self.data_version = prod_data_version(prod_id)
+        return '"{}-{}-{}-{}"'.format(prod_id, self.rehearsal.id,
+            self.data_version, self.request.user.id)
+    
+    def get_json_data(self):
+        prod_id = self.rehearsal.production_id
+        return cached_prod_data(prod_id,
+            'atnd_graph:{}'.format(self.rehearsal.id),
+            atnd_graph_data, self.rehearsal, version=self.data_version)
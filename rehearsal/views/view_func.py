@@ -0,0 +1,79 @@
+import json
+from django.contrib import messages
+from django.core.cache import cache
+from django.utils.cache import get_conditional_response, patch_cache_control
+from production.models import Production
+
+
+def prod_data_version(prod_id):
+    '''公演のデータのバージョンを取得する
+    '''
+    return Production.objects.values_list('data_version', flat=True)\
+        .get(pk=prod_id)
+
+
+def cached_prod_data(prod_id, name, build_data, *args, version=None):
+    '''公演のデータから作った JSON の dict を、キャッシュを使って取得する
+    
+    キャッシュのキーに公演のデータのバージョンを含めるので、
+    データが変更された後は作り直す
+    
+    Parameters
+    ----------
+    prod_id : int
+        公演の id
+    name : str
+        キャッシュするデータの名前 (公演の中で一意にする)
+    build_data : function
+        args を渡すと、JSON にする値の dict を返す関数
+    version : int
+        公演のデータのバージョン. 省略するとデータベースから取得する
+    
+    Returns
+    -------
+    data : dict
+        build_data() が返した値を JSON 文字列にした dict
+    '''
+    if version is None:
+        version = prod_data_version(prod_id)
+    key = 'rehearsal:{}:{}:{}'.format(prod_id, name, version)
+    data = cache.get(key)
+    if data is None:
+        data = {k: json.dumps(v) for k, v in build_data(*args).items()}
+        cache.set(key, data)
+    return data
+
+
+class ProdDataConditionalMixin:
+    '''公演のデータのバージョンを ETag にして、条件付き GET に応える Mixin
+    
+    If-None-Match が一致すれば、コンテキストを作らずに 304 を返す
+    アクセス権の検査は、サブクラスの get() で先に済ませておくこと
+    '''
+    def get(self, request, *args, **kwargs):
+        '''表示時のリクエストを受けたハンドラ
+        '''
+        etag = self.get_data_etag()
+        
+        # 表示待ちのメッセージがなければ、ETag を検査する
+        response = None
+        if len(messages.get_messages(request)) < 1:
+            response = get_conditional_response(request, etag=etag)
+        if response is None:
+            response = super().get(request, *args, **kwargs)
+        
+        # 毎回検証させる
+        response['ETag'] = etag
+        patch_cache_control(response, private=True, no_cache=True)
+        return response
+    
+    def get_data_etag(self):
+        '''ETag を作る
+        
+        ページにユーザ名を表示するので、ユーザの id も含める
+        '''
+        prod_id = self.kwargs['prod_id']
+        # コンテキストを作る時にも使うので、属性として持っておく
+        self.data_version = prod_data_version(prod_id)
+        return '"{}-{}-{}"'.format(
+            prod_id, self.data_version, self.request.user.id)
@@ -1,3 +1,4 @@
+from datetime import datetime, timedelta, timezone
 from operator import attrgetter
 from django.views.generic import ListView, TemplateView, DetailView
 from django.views.generic.edit import CreateView, UpdateView, DeleteView
@@ -6,7 +7,9 @@ from django.urls import reverse_lazy
 from django.contrib import messages
 from django.contrib.auth.mixins import LoginRequiredMixin
 from django.core.exceptions import PermissionDenied
-from production.models import Production
+from django.db.models import Q
+from django.utils.dateparse import parse_date
+from production.models import Production, ProdUser
 from rehearsal.models import Rehearsal, Scene, Place, Facility, Character,\
     Actor, Appearance, ScnComment, Attendance, AtndChangeLog
 from rehearsal.forms import RhslForm, ChrForm, ActrForm, ScnApprForm,\
@@ -14,6 +17,10 @@ from rehearsal.forms import RhslForm, ChrForm, ActrForm, ScnApprForm,\
 from production.view_func import *
 
 
+# 変更履歴のページ送りのカーソルの基準時刻
+LOG_CURSOR_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
 class ProdBaseListView(LoginRequiredMixin, ListView):
     '''アクセス権を検査する ListView の Base class
     '''
@@ -1416,8 +1423,9 @@ class AtndCreate(LoginRequiredMixin, CreateView):
         # 変更履歴を保存
         prod_user = accessing_prod_user(self, self.rehearsal.production.id)
         change_log = AtndChangeLog(production=self.rehearsal.production,
-            old_value='', new_value=new_atnd,
-            changed_by=prod_user.user, changed_by_id=prod_user.id)
+            changed_by=prod_user.user, changed_by_id=prod_user.id,
+            rehearsal=self.rehearsal, actor=self.actor)
+        change_log.set_atnds(None, new_atnd)
         change_log.save()
         
         messages.success(self.request, str(new_atnd) + " を追加しました。")
@@ -1517,8 +1525,10 @@ class AtndUpdate(LoginRequiredMixin, UpdateView):
         
         # actor, rehearsal を view の属性として持っておく
         # 保存時にインスタンスにセットするため
-        self.actor = self.get_object().actor
-        self.rehearsal = self.get_object().rehearsal
+        # 変更前の参加時間も、変更履歴のために持っておく
+        self.old_atnd = self.get_object()
+        self.actor = self.old_atnd.actor
+        self.rehearsal = self.old_atnd.rehearsal
         
         # 役者の production と 稽古の production が違ったら 404
         if self.actor.production != self.rehearsal.production:
@@ -1537,8 +1547,9 @@ class AtndUpdate(LoginRequiredMixin, UpdateView):
         # 変更履歴を保存
         prod_user = accessing_prod_user(self, self.rehearsal.production.id)
         change_log = AtndChangeLog(production=self.rehearsal.production,
-            old_value=self.get_object(), new_value=form.instance,
-            changed_by=prod_user.user, changed_by_id=prod_user.id)
+            changed_by=prod_user.user, changed_by_id=prod_user.id,
+            rehearsal=self.rehearsal, actor=self.actor)
+        change_log.set_atnds(self.old_atnd, form.instance)
         change_log.save()
 
         messages.success(self.request, str(form.instance) + " を更新しました。")
@@ -1625,8 +1636,9 @@ class AtndDelete(LoginRequiredMixin, DeleteView):
         # 変更履歴を保存
         prod_user = accessing_prod_user(self, self.object.rehearsal.production.id)
         change_log = AtndChangeLog(production=self.object.rehearsal.production,
-            old_value=self.object, new_value='',
-            changed_by=prod_user.user, changed_by_id=prod_user.id)
+            changed_by=prod_user.user, changed_by_id=prod_user.id,
+            rehearsal=self.object.rehearsal, actor=self.object.actor)
+        change_log.set_atnds(self.object, None)
         change_log.save()
 
         messages.success(
@@ -1637,15 +1649,112 @@ class AtndDelete(LoginRequiredMixin, DeleteView):
 class AtndChangeList(ProdBaseListView):
     '''AtndChangeList のリストビュー
 
-    Template 名: atndchangelog_list (default)
+    新しい順に、(記録日時, id) をキーにしたページ送りで表示する
+    役者、稽古の日付、変更者で絞り込める
+
+    Template 名: atndchangelog_list
     '''
     model = AtndChangeLog
+    # get_queryset() がリストを返すので、テンプレートを指定する
+    template_name = 'rehearsal/atndchangelog_list.html'
+    # 1ページの件数
+    page_size = 50
     
     def get_queryset(self):
         '''リストに表示するレコードをフィルタする
         '''
         prod_id=self.kwargs['prod_id']
-        logs = AtndChangeLog.objects.filter(production__pk=prod_id)\
-            .order_by('-create_dt')
+        logs = AtndChangeLog.objects.filter(production__pk=prod_id)
+        
+        # 絞り込み
+        self.filters = {}
+        actr_id = self.request.GET.get('actor', '')
+        if actr_id.isdecimal():
+            logs = logs.filter(actor_id=actr_id)
+            self.filters['actor'] = int(actr_id)
+        date = parse_date_or_none(self.request.GET.get('date', ''))
+        if date:
+            logs = logs.filter(rehearsal_date=date)
+            self.filters['date'] = date
+        changer_id = self.request.GET.get('changer', '')
+        if changer_id.isdecimal():
+            logs = logs.filter(changed_by_id=changer_id)
+            self.filters['changer'] = int(changer_id)
+        
+        # 前のページの最後のレコードより古いもの
+        cursor = parse_log_cursor(self.request.GET.get('cursor', ''))
+        if cursor:
+            create_dt, log_id = cursor
+            logs = logs.filter(Q(create_dt__lt=create_dt)
+                | Q(create_dt=create_dt, id__lt=log_id))
+        self.is_first_page = cursor is None
+        
+        # 次のページがあるか分かるように、1件多く取得する
+        logs = list(logs.order_by('-create_dt', '-id')[:self.page_size + 1])
+        self.next_cursor = None
+        if len(logs) > self.page_size:
+            logs = logs[:self.page_size]
+            self.next_cursor = log_cursor(logs[-1])
         
         return logs
+    
+    def get_context_data(self, **kwargs):
+        '''テンプレートに渡すパラメタを改変する
+        '''
+        context = super().get_context_data(**kwargs)
+        
+        prod_id = self.kwargs['prod_id']
+        
+        # 絞り込みの選択肢
+        context['actors'] = Actor.objects.filter(production__pk=prod_id)
+        context['prod_users'] = ProdUser.objects.filter(
+            production__pk=prod_id).select_related('user')
+        context['filters'] = self.filters
+        
+        # 絞り込みを保った、次のページと最初のページのクエリ文字列
+        query = self.request.GET.copy()
+        query.pop('cursor', None)
+        context['first_page_query'] = query.urlencode()
+        if self.next_cursor:
+            query['cursor'] = self.next_cursor
+            context['next_page_query'] = query.urlencode()
+        context['is_first_page'] = self.is_first_page
+        
+        return context
+
+
+def log_cursor(log):
+    '''変更履歴のページ送りのカーソル文字列を作る
+
+    記録日時 (UNIX 時間のマイクロ秒) と id を '_' で繋げる
+    '''
+    micro_secs = (log.create_dt - LOG_CURSOR_EPOCH) // timedelta(microseconds=1)
+    return '{}_{}'.format(micro_secs, log.id)
+
+
+def parse_log_cursor(cursor):
+    '''変更履歴のページ送りのカーソル文字列を解釈する
+
+    Returns
+    -------
+    cursor : tuple
+        (記録日時, id). 正しくなければ None
+    '''
+    micro_secs, _, log_id = cursor.partition('_')
+    if not micro_secs.isdecimal() or not log_id.isdecimal():
+        return None
+    try:
+        return (LOG_CURSOR_EPOCH + timedelta(microseconds=int(micro_secs)),
+            int(log_id))
+    except (OverflowError, ValueError):
+        # 日時の範囲外
+        return None
+
+
+def parse_date_or_none(value):
+    ''''YYYY-MM-DD' の文字列を date にする (正しくなければ None)
+    '''
+    try:
+        return parse_date(value)
+    except ValueError:
+        return None
@@ -3,3 +3,7 @@ from django.apps import AppConfig
 
 class ScriptConfig(AppConfig):
     name = 'script'
+    
+    def ready(self):
+        # 表示用の HTML を作るシグナルを登録する
+        from . import signals
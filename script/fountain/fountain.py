@@ -6,13 +6,37 @@ Based on Fountain by Nima Yousefi & John August
 Original code for Objective-C at https://github.com/nyousefi/Fountain
 Further Edited by Manuel Senfft
 """
+import itertools
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
 
 
 COMMON_TRANSITIONS = {'FADE OUT.', 'CUT TO BLACK.', 'FADE TO BLACK.'}
 UPPER_ALPHABETS = 'ABCDEFGHIJKLMNOPQRSTUVWXYZ'
+UPPER_ALPHABETS_RE = re.compile('[A-Z]*')
+SCENE_HEADING_PREFIXES_4 = frozenset(
+    ['INT ', 'INT.', 'EXT ', 'EXT.', 'EST ', 'EST.', 'I/E ', 'I/E.'])
+SCENE_HEADING_PREFIXES_8 = frozenset(['INT/EXT ', 'INT/EXT.'])
+SCENE_HEADING_PREFIXES_9 = frozenset(['INT./EXT ', 'INT./EXT.'])
+# Elements which continue a dialogue block for dual dialogue
+DIALOGUE_BLOCK_TYPES = frozenset(
+    ['Character', 'Dialogue', 'Parenthetical', 'Empty Line'])
 
 
 class FountainElement:
+    __slots__ = (
+        'element_type',
+        'element_text',
+        'section_depth',
+        'scene_number',
+        'scene_abbreviation',
+        'is_centered',
+        'is_dual_dialogue',
+        'original_line',
+        'original_content',
+    )
+
     def __init__(
         self,
         element_type,
@@ -40,7 +64,8 @@ class FountainElement:
 
 
 class Fountain:
-    def __init__(self, string=None, path=None):
+    def __init__(self, string=None, path=None, skip_empty_lines=False):
+        self.skip_empty_lines = skip_empty_lines
         self.metadata = dict()
         self.elements = list()
 
@@ -53,19 +78,50 @@ class Fountain:
             self.parse()
 
     def parse(self):
-        contents = self.contents.strip().replace('\r', '')
+        reader = FountainReader(
+            self.contents, skip_empty_lines=self.skip_empty_lines)
+        self.metadata = reader.metadata
+        self.elements = list(reader)
+
+
+class FountainReader:
+    """Streaming parser.
+
+    The source is a string, a file object or an iterable of lines.
+    The title page is read on construction into ``metadata``, and the
+    elements are parsed lazily while iterating over the reader.
+    With ``skip_empty_lines``, no 'Empty Line' elements are made.
+
+    Only the current dialogue block is held back (for dual dialogue), so
+    memory does not grow with the length of the script when the source
+    is a file object or an iterable of lines.
+    """
+    def __init__(self, source, skip_empty_lines=False):
+        self.skip_empty_lines = skip_empty_lines
+        self.metadata = dict()
 
-        contents_has_metadata = ':' in contents.splitlines()[0]
-        contents_has_body = '\n\n' in contents
+        if isinstance(source, str):
+            lines = iter(source.strip().replace('\r', '').splitlines())
+        else:
+            lines = _strip_lines(source)
 
-        if contents_has_metadata and contents_has_body:
-            script_head, script_body = contents.split('\n\n', 1)
-            self._parse_head(script_head.splitlines())
-            self._parse_body(script_body.splitlines())
-        elif contents_has_metadata and not contents_has_body:
-            self._parse_head(contents.splitlines())
+        first_line = next(lines, None)
+        if first_line is None:
+            self._body = iter(())
+        elif ':' in first_line:
+            script_head = [first_line]
+            for line in lines:
+                if not line:
+                    break
+                script_head.append(line)
+            self._parse_head(script_head)
+            self._body = self._parse_body(lines)
         else:
-            self._parse_body(contents.splitlines())
+            self._body = self._parse_body(
+                itertools.chain([first_line], lines))
+
+    def __iter__(self):
+        return self._body
 
     def _parse_head(self, script_head):
         open_key = None
@@ -81,29 +137,55 @@ class Fountain:
                 self.metadata[key.strip().lower()] = [value.strip()]
 
     def _parse_body(self, script_body):
+        """Yield the elements of the body lines.
+
+        An element is held back while a later line can still modify it:
+        the last element (continued lines) and everything from the last
+        Character until its dialogue block ends (dual dialogue). A ``^``
+        Character marks the Character of the dialogue block right before
+        it, as in the Fountain syntax.
+        """
         is_comment_block = False
         is_inside_dialogue_block = False
         newlines_before = 0
-        index = -1
         comment_text = list()
+        elements = list()
+        last_character = -1
+
+        for linenum, line, next_line in _with_next(script_body):
+            # The dialogue block of the last Character has ended
+            if (
+                last_character >= 0 and
+                elements[-1].element_type not in DIALOGUE_BLOCK_TYPES
+            ):
+                last_character = -1
+
+            # Yield the elements which no longer change
+            keep = last_character if last_character >= 0 \
+                else len(elements) - 1
+            if keep > 0:
+                yield from elements[:keep]
+                del elements[:keep]
+                if last_character >= 0:
+                    last_character -= keep
 
-        for linenum, line in enumerate(script_body):
-            assert type(line) is str
-            index += 1
             line = line.lstrip()
             full_strip = line.strip()
+            # Most line types are decided by the first character
+            first = line[:1]
 
             if (not line or line.isspace()) and not is_comment_block:
-                self.elements.append(FountainElement('Empty Line'))
+                if not self.skip_empty_lines:
+                    elements.append(FountainElement('Empty Line'))
                 is_inside_dialogue_block = False
                 newlines_before += 1
                 continue
 
-            if line.startswith('/*'):
+            if first == '/' and line.startswith('/*'):
                 line = line.rstrip()
                 if line.endswith('*/'):
                     text = line.replace('/*', '').replace('*/', '')
-                    self.elements.append(
+                    elements.append(
                         FountainElement(
                             'Boneyard',
                             text,
@@ -121,7 +203,7 @@ class Fountain:
             if line.rstrip().endswith('*/'):
                 text = line.replace('*/', '')
                 comment_text.append(text.strip())
-                self.elements.append(
+                elements.append(
                     FountainElement(
                         'Boneyard',
                         '\n'.join(comment_text),
@@ -138,8 +220,8 @@ class Fountain:
                 comment_text.append(line)
                 continue
 
-            if line.startswith('==='):
-                self.elements.append(
+            if first == '=' and line.startswith('==='):
+                elements.append(
                     FountainElement(
                         'Page Break',
                         line,
@@ -150,8 +232,8 @@ class Fountain:
                 newlines_before = 0
                 continue
 
-            if len(full_strip) > 0 and full_strip[0] == '=':
-                self.elements.append(
+            if first == '=':
+                elements.append(
                     FountainElement(
                         'Synopsis',
                         full_strip[1:].strip(),
@@ -162,11 +244,12 @@ class Fountain:
                 continue
 
             if (
+                first == '[' and
                 newlines_before > 0 and
                 full_strip.startswith('[[') and
                 full_strip.endswith(']]')
             ):
-                self.elements.append(
+                elements.append(
                     FountainElement(
                         'Comment',
                         full_strip.strip('[] \t'),
@@ -176,10 +259,10 @@ class Fountain:
                 )
                 continue
 
-            if len(full_strip) > 0 and full_strip[0] == '#':
+            if first == '#':
                 newlines_before = 0
                 depth = full_strip.split()[0].count('#')
-                self.elements.append(
+                elements.append(
                     FountainElement(
                         'Section Heading',
                         full_strip[depth:].strip(),
@@ -190,12 +273,12 @@ class Fountain:
                 )
                 continue
 
-            if len(line) > 1 and line[0] == '.' and line[1] != '.':
+            if first == '.' and len(line) > 1 and line[1] != '.':
                 newlines_before = 0
                 if full_strip[-1] == '#' and full_strip.count('#') > 1:
                     scene_number_start = len(full_strip) - \
                         full_strip[::-1].find('#', 1) - 1
-                    self.elements.append(
+                    elements.append(
                         FountainElement(
                             'Scene Heading',
                             full_strip[1:scene_number_start].strip(),
@@ -207,7 +290,7 @@ class Fountain:
                         )
                     )
                 else:
-                    self.elements.append(
+                    elements.append(
                         FountainElement(
                             'Scene Heading',
                             full_strip[1:].strip(),
@@ -218,17 +301,18 @@ class Fountain:
                 continue
 
             if (
-                line[0:4].upper() in
-                ['INT ', 'INT.', 'EXT ', 'EXT.', 'EST ', 'EST.', 'I/E ', 'I/E.'] or
-                line[0:8].upper() in ['INT/EXT ', 'INT/EXT.'] or
-                line[0:9].upper() in ['INT./EXT ', 'INT./EXT.']
+                (first in 'IEie' or not first.isascii()) and (
+                    line[0:4].upper() in SCENE_HEADING_PREFIXES_4 or
+                    line[0:8].upper() in SCENE_HEADING_PREFIXES_8 or
+                    line[0:9].upper() in SCENE_HEADING_PREFIXES_9
+                )
             ):
                 newlines_before = 0
                 scene_name_start = line.find(line.split()[1])
                 if full_strip[-1] == '#' and full_strip.count('#') > 1:
                     scene_number_start = len(full_strip) - \
                         full_strip[::-1].find('#', 1) - 1
-                    self.elements.append(
+                    elements.append(
                         FountainElement(
                             'Scene Heading',
                             full_strip[
@@ -243,7 +327,7 @@ class Fountain:
                         )
                     )
                 else:
-                    self.elements.append(
+                    elements.append(
                         FountainElement(
                             'Scene Heading',
                             full_strip[scene_name_start:].strip(),
@@ -256,7 +340,7 @@ class Fountain:
 
             if full_strip.endswith(' TO:'):
                 newlines_before = 0
-                self.elements.append(
+                elements.append(
                     FountainElement(
                         'Transition',
                         full_strip,
@@ -268,7 +352,7 @@ class Fountain:
 
             if full_strip in COMMON_TRANSITIONS:
                 newlines_before = 0
-                self.elements.append(
+                elements.append(
                     FountainElement(
                         'Transition',
                         full_strip,
@@ -278,10 +362,10 @@ class Fountain:
                 )
                 continue
 
-            if full_strip[0] == '>':
+            if first == '>':
                 newlines_before = 0
                 if len(full_strip) > 1 and full_strip[-1] == '<':
-                    self.elements.append(
+                    elements.append(
                         FountainElement(
                             'Action',
                             full_strip[1:-1].strip(),
@@ -291,7 +375,7 @@ class Fountain:
                         )
                     )
                 else:
-                    self.elements.append(
+                    elements.append(
                         FountainElement(
                             'Transition',
                             full_strip[1:].strip(),
@@ -303,19 +387,18 @@ class Fountain:
 
             if (
                 newlines_before > 0 and
-                index + 1 < len(script_body) and
-                script_body[index + 1] and
-                not line[0] in ['[', ']', ',', '(', ')'] and
-                (all([(c in UPPER_ALPHABETS) for c in full_strip])
-                    or full_strip[0] == '@')
+                next_line and
+                first not in '[],()' and
+                (UPPER_ALPHABETS_RE.fullmatch(full_strip) or first == '@')
             ):
                 newlines_before = 0
                 if full_strip[-1] == '^':
-                    for element in reversed(self.elements):
+                    for element in reversed(elements):
                         if element.element_type == 'Character':
                             element.is_dual_dialogue = True
                             break
-                    self.elements.append(
+                    last_character = len(elements)
+                    elements.append(
                         FountainElement(
                             'Character',
                             full_strip.lstrip('@').rstrip('^').strip(),
@@ -326,7 +409,8 @@ class Fountain:
                     )
                     is_inside_dialogue_block = True
                 else:
-                    self.elements.append(
+                    last_character = len(elements)
+                    elements.append(
                         FountainElement(
                             'Character',
                             full_strip.lstrip('@'),
@@ -338,8 +422,8 @@ class Fountain:
                 continue
 
             if is_inside_dialogue_block:
-                if newlines_before == 0 and full_strip[0] == '(':
-                    self.elements.append(
+                if newlines_before == 0 and first == '(':
+                    elements.append(
                         FountainElement(
                             'Parenthetical',
                             full_strip,
@@ -348,12 +432,12 @@ class Fountain:
                         )
                     )
                 else:
-                    if self.elements[-1].element_type == 'Dialogue':
-                        self.elements[-1].element_text = '\n'.join(
-                            [self.elements[-1].element_text, full_strip]
+                    if elements[-1].element_type == 'Dialogue':
+                        elements[-1].element_text = '\n'.join(
+                            [elements[-1].element_text, full_strip]
                         )
                     else:
-                        self.elements.append(
+                        elements.append(
                             FountainElement(
                                 'Dialogue',
                                 full_strip,
@@ -363,12 +447,12 @@ class Fountain:
                         )
                 continue
 
-            if newlines_before == 0 and len(self.elements) > 0:
-                self.elements[-1].element_text = '\n'.join(
-                    [self.elements[-1].element_text, full_strip])
+            if newlines_before == 0 and len(elements) > 0:
+                elements[-1].element_text = '\n'.join(
+                    [elements[-1].element_text, full_strip])
                 newlines_before = 0
             else:
-                self.elements.append(
+                elements.append(
                     FountainElement(
                         'Action',
                         full_strip,
@@ -377,3 +461,147 @@ class Fountain:
                     )
                 )
                 newlines_before = 0
+
+        yield from elements
+
+
+def parse_parallel(string, executor=None, min_chunk_lines=2000,
+                   skip_empty_lines=False):
+    """Parse a script in chunks on a process pool.
+
+    The body is split at blank lines before a Scene or Section Heading
+    (outside of boneyard), where the parser state is reset, and the
+    chunks are parsed in parallel. The elements are the same as those of
+    ``FountainReader(string)``.
+
+    Returns a tuple of the metadata and the list of elements.
+    """
+    lines = string.strip().replace('\r', '').splitlines()
+
+    # Title page
+    script_body = lines
+    if lines and ':' in lines[0]:
+        if '' in lines:
+            body_start = lines.index('')
+            script_body = lines[body_start + 1:]
+        else:
+            body_start = len(lines)
+            script_body = list()
+        metadata = FountainReader(lines[:body_start]).metadata
+    else:
+        metadata = dict()
+
+    starts = _chunk_starts(script_body, min_chunk_lines)
+    chunks = [
+        (script_body[start:end], skip_empty_lines)
+        for start, end in zip(starts, starts[1:] + [len(script_body)])
+    ]
+    if len(chunks) < 2 or (executor is None and (os.cpu_count() or 1) < 2):
+        results = map(_parse_chunk, chunks)
+    elif executor is None:
+        with ProcessPoolExecutor() as executor:
+            results = list(executor.map(_parse_chunk, chunks))
+    else:
+        results = executor.map(_parse_chunk, chunks)
+
+    # Stitch the chunks (dual dialogue does not cross a heading)
+    elements = list()
+    for start, chunk_elements in zip(starts, results):
+        for element in chunk_elements:
+            if element.element_type != 'Empty Line':
+                element.original_line += start
+        elements.extend(chunk_elements)
+
+    return metadata, elements
+
+
+def _chunk_starts(script_body, min_chunk_lines):
+    """Return the line indexes where the body can be split."""
+    starts = [0]
+    is_comment_block = False
+    # The boneyard text is kept until the closing line of a block
+    has_comment_text = False
+    for index, line in enumerate(script_body):
+        line = line.lstrip()
+        if (not line or line.isspace()) and not is_comment_block:
+            continue
+        if line.startswith('/*'):
+            if line.rstrip().endswith('*/'):
+                is_comment_block = False
+            else:
+                is_comment_block = has_comment_text = True
+            continue
+        if line.rstrip().endswith('*/'):
+            is_comment_block = has_comment_text = False
+            continue
+        if (
+            is_comment_block or
+            has_comment_text or
+            index - starts[-1] < max(min_chunk_lines, 1) or
+            script_body[index - 1]
+        ):
+            continue
+        if (
+            line[0] == '#' or
+            (len(line) > 1 and line[0] == '.' and line[1] != '.') or
+            line[0:4].upper() in SCENE_HEADING_PREFIXES_4 or
+            line[0:8].upper() in SCENE_HEADING_PREFIXES_8 or
+            line[0:9].upper() in SCENE_HEADING_PREFIXES_9
+        ):
+            starts.append(index)
+    return starts
+
+
+def _parse_chunk(args):
+    """Parse the body lines of a chunk (in a worker process)."""
+    script_body, skip_empty_lines = args
+    reader = FountainReader('', skip_empty_lines=skip_empty_lines)
+    return list(reader._parse_body(script_body))
+
+
+def iter_lines(string):
+    """Yield the lines of a string one by one (with their line ends).
+
+    Unlike ``str.splitlines()``, no list of all the lines is made, so
+    ``FountainReader(iter_lines(string))`` reads a long script lazily.
+    """
+    start = 0
+    length = len(string)
+    while start < length:
+        end = string.find('\n', start)
+        end = length if end < 0 else end + 1
+        yield string[start:end]
+        start = end
+
+
+def _strip_lines(source):
+    """Yield the lines of the source as ``str.strip().splitlines()`` would."""
+    last_line = None
+    blank_lines = list()
+    for chunk in source:
+        for line in chunk.replace('\r', '').splitlines() or ['']:
+            if line.isspace() or not line:
+                if last_line is not None:
+                    blank_lines.append(line)
+                continue
+            if last_line is None:
+                line = line.lstrip()
+            else:
+                yield last_line
+                yield from blank_lines
+                blank_lines.clear()
+            last_line = line
+    if last_line is not None:
+        yield last_line.rstrip()
+
+
+def _with_next(lines):
+    """Yield (line number, line, next line or None) for each line."""
+    lines = iter(lines)
+    line = next(lines, None)
+    linenum = 0
+    while line is not None:
+        next_line = next(lines, None)
+        yield linenum, line, next_line
+        line = next_line
+        linenum += 1
@@ -0,0 +1,101 @@
+import random
+import time
+from django.core.management.base import BaseCommand
+from django.test.utils import override_settings
+from script.fountain import fountain
+from script.views.view_func import html_from_fountain
+
+
+def synthetic_fountain(size, seed=0):
+    '''ベンチマーク用の Fountain フォーマットの台本を作る
+
+    セリフとト書きを中心に、ときどき柱やシーン見出しを入れる
+
+    Parameters
+    ----------
+    size : int
+        台本のおよその文字数
+    seed : int
+        乱数のシード (同じなら同じ台本になる)
+
+    Returns
+    -------
+    text : str
+        台本のテキストデータ
+    '''
+    rand = random.Random(seed)
+    lines = ['Title: ベンチマーク', 'Author: pscweb2', '']
+    length = 0
+    while length < size:
+        block = ['', rand.choice(['TARO', 'HANAKO', 'JIRO', '@三橋']),
+            rand.choice(['Hello there, how are you today?',
+                'こんにちは、元気ですか。']),
+            rand.choice(['', 'ト書きが続く。', '(smiling)'])]
+        if rand.random() < 0.05:
+            block += ['', '## 場面{}'.format(len(lines))]
+        if rand.random() < 0.05:
+            block += ['', 'INT. HOUSE - DAY', '',
+                'Some action happens here.', 'ト書きが続く。']
+        lines.extend(block)
+        length += sum(len(line) + 1 for line in block)
+    return '\n'.join(lines)
+
+
+def parse_fountain(text):
+    '''台本をパースして、要素をすべて読む
+    '''
+    return list(fountain.FountainReader(text))
+
+
+# 測る処理 (名前 -> (説明, 関数))
+TARGETS = {
+    'html': ('HTML の生成', html_from_fountain),
+    'parser': ('パース', parse_fountain),
+}
+
+
+def best_time(func, *args, repeat=3):
+    '''関数を何度か実行して、最短の実行時間 (秒) を返す
+    '''
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(*args)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+class Command(BaseCommand):
+    '''合成した台本で、台本の処理にかかる時間を測るコマンド
+    '''
+    help = '合成した大きさの違う台本で、HTML の生成やパースにかかる時間を測る'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--target', choices=list(TARGETS),
+            default='html', help='測る処理 (html: HTML の生成, parser: パース)')
+        parser.add_argument('--sizes', type=float, nargs='+',
+            default=[1, 2, 4], help='台本の文字数 (100万文字単位)')
+        parser.add_argument('--repeat', type=int, default=3,
+            help='測る回数 (最短の時間を使う)')
+
+    def handle(self, *args, **options):
+        label, func = TARGETS[options['target']]
+        self.stdout.write(label)
+
+        results = []
+        for size in options['sizes']:
+            text = synthetic_fountain(int(size * 1000 * 1000))
+            # パースした台本のキャッシュを使わずに、毎回パースする
+            with override_settings(SCRIPT_PARSE_CACHE_SIZE=0):
+                seconds = best_time(func, text, repeat=options['repeat'])
+            results.append((len(text), seconds))
+            self.stdout.write('{:.1f}M 文字: {:.3f} 秒 ({:.2f}M 文字/秒, '
+                '{:.2f} MB/秒)'.format(len(text) / 1e6, seconds,
+                    len(text) / seconds / 1e6,
+                    len(text.encode()) / seconds / 1e6))
+
+        # 文字数あたりの時間が一定なら、文字数に比例している
+        base_length, base_seconds = results[0]
+        self.stdout.write('文字数あたりの時間 (最初の台本との比): ' + ', '.join(
+            '{:.2f}'.format(seconds / length * base_length / base_seconds)
+            for length, seconds in results))
@@ -0,0 +1,81 @@
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+import os
+from django.core.management.base import BaseCommand
+from script.fountain import fountain
+from script.models import Script
+from script.views.view_func import data_from_elements
+
+
+def summarize_elements(elements):
+    '''台本の要素から、要素、登場人物、シーン、出番の数を数える
+    '''
+    characters, scenes, appearance = data_from_elements(elements)
+    appr_num = sum(len(scn_appr) for scn_appr in appearance)
+    return len(elements), len(characters), len(scenes), appr_num
+
+
+def summarize_script(raw_data):
+    '''台本をパースして、要素、登場人物、シーン、出番の数を返す
+
+    小さい台本を、1つのプロセスで丸ごとパースする
+    '''
+    elements = list(fountain.FountainReader(raw_data, skip_empty_lines=True))
+    return summarize_elements(elements)
+
+
+class Command(BaseCommand):
+    '''台本をまとめてパースし、登場人物やシーンの数を表示するコマンド
+    '''
+    help = '台本を複数のプロセスでパースし、登場人物、シーン、出番の数を表示する'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--public', action='store_true',
+            help='公開されている台本だけを対象にする')
+        parser.add_argument('--workers', type=int, default=None,
+            help='パースするプロセスの数 (省略すると CPU の数)')
+        parser.add_argument('--min-chunk-lines', type=int, default=2000,
+            help='1つのプロセスでパースする最小の行数')
+
+    def handle(self, *args, **options):
+        # Fountain フォーマットの台本
+        scripts = Script.objects.filter(format=1).order_by('id')
+        if options['public']:
+            scripts = scripts.filter(public_level=2)
+        scripts = scripts.only('id', 'title', 'raw_data')
+
+        min_chunk_lines = options['min_chunk_lines']
+        # 台本のデータを溜めすぎないように、パース中の台本の数を抑える
+        max_pending = (options['workers'] or os.cpu_count() or 1) * 4
+
+        with ProcessPoolExecutor(options['workers']) as executor:
+            # (台本, 結果の Future) を、台本の順に表示するまで持っておく
+            pending = deque()
+            for script in scripts.iterator():
+                if script.raw_data.count('\n') < min_chunk_lines:
+                    # 区切れない台本は、丸ごと1つのプロセスでパースする
+                    future = executor.submit(summarize_script,
+                        script.raw_data)
+                else:
+                    # 長い台本は、区切って複数のプロセスでパースする
+                    _, elements = fountain.parse_parallel(script.raw_data,
+                        executor, min_chunk_lines=min_chunk_lines,
+                        skip_empty_lines=True)
+                    future = Future()
+                    future.set_result(summarize_elements(elements))
+                pending.append((script.id, script.title, future))
+
+                while pending and (len(pending) > max_pending
+                        or pending[0][2].done()):
+                    self.write_result(*pending.popleft())
+
+            while pending:
+                self.write_result(*pending.popleft())
+
+    def write_result(self, scrpt_id, title, future):
+        '''台本のパースの結果を表示する
+        '''
+        elmts_num, chrs_num, scns_num, apprs_num = future.result()
+        self.stdout.write('{} {}: 要素 {}, 登場人物 {}, シーン {}, '
+            '出番 {}'.format(scrpt_id, title, elmts_num, chrs_num, scns_num,
+                apprs_num))
@@ -0,0 +1,18 @@
+# Generated by Django 3.2.25 on 2026-10-18 19:06
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('script', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='script',
+            name='html',
+            field=models.TextField(blank=True, editable=False, verbose_name='HTML'),
+        ),
+    ]
@@ -24,6 +24,7 @@ class Script(models.Model):
     )
     public_level = models.IntegerField('公開レベル', default=1,
         choices=PUBLIC_LEVEL_CHOICES)
+    html = models.TextField('HTML', blank=True, editable=False)
     
     class Meta:
         verbose_name = verbose_name_plural = '台本'
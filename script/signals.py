@@ -0,0 +1,25 @@
+from django.conf import settings
+from django.db.models.signals import pre_save
+from .models import Script
+from .views.view_func import html_from_fountain
+
+
+def render_script_html(sender, instance, **kwargs):
+    '''台本のデータが変更されたら、表示用の HTML を作り直す
+    '''
+    # 長い台本は、表示の都度少しずつ作る
+    if len(instance.raw_data) > settings.SCRIPT_VIEWER_STREAMING_SIZE:
+        instance.html = ''
+        return
+    
+    # データが変わっていなければ、作り直さない
+    if instance.pk is not None and instance.html:
+        old_raw_data = Script.objects.filter(pk=instance.pk)\
+            .values_list('raw_data', flat=True).first()
+        if old_raw_data == instance.raw_data:
+            return
+    
+    instance.html = html_from_fountain(instance.raw_data)
+
+
+pre_save.connect(render_script_html, sender=Script)
@@ -1,3 +1,436 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, time
+from unittest import mock
+from django.core.cache import cache
 from django.test import TestCase
+from django.urls import reverse
+from accounts.models import User
+from production.models import Production
+from rehearsal.models import Rehearsal, Scene, Actor, Character, Appearance,\
+    Attendance, ScnComment
+from script.fountain import fountain
+from script.models import Script
+from script.views.view_func import html_chunks_from_fountain,\
+    html_from_fountain, script_cache_key, add_data_from_script, sync_data_from_script
 
-# Create your tests here.
+
+SCRIPT_TEXT = '''Title: テスト台本
+Author: テスト作者
+
+# シーン1
+
+TARO
+こんにちは。
+
+ト書き。
+
+# シーン2
+
+HANAKO
+さようなら。
+'''
+
+
+class ScriptChunkCacheTest(TestCase):
+    '''台本の目次と断片を、別々のキャッシュから返すことのテスト
+    '''
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user('tester', password='password')
+        self.client.force_login(self.user)
+        self.script = Script.objects.create(title='テスト台本',
+            raw_data=SCRIPT_TEXT, owner=self.user)
+        self.chunks = html_chunks_from_fountain(SCRIPT_TEXT)
+
+    def test_toc_and_chunks(self):
+        response = self.client.get(reverse('script:scrpt_toc',
+            kwargs={'pk': self.script.pk}))
+        self.assertEqual(response.context['chunk_titles'],
+            [chunk['title'] for chunk in self.chunks])
+
+        for idx, chunk in enumerate(self.chunks):
+            response = self.client.get(reverse('script:scrpt_chunk',
+                kwargs={'pk': self.script.pk, 'idx': idx}))
+            self.assertEqual(response.content.decode(), chunk['html'])
+
+        response = self.client.get(reverse('script:scrpt_chunk',
+            kwargs={'pk': self.script.pk, 'idx': len(self.chunks)}))
+        self.assertEqual(response.status_code, 404)
+
+    def test_chunk_reads_only_its_key(self):
+        # 目次を表示すると、断片もキャッシュされる
+        self.client.get(reverse('script:scrpt_toc',
+            kwargs={'pk': self.script.pk}))
+
+        with mock.patch.object(cache, 'get', wraps=cache.get) as cache_get:
+            response = self.client.get(reverse('script:scrpt_chunk',
+                kwargs={'pk': self.script.pk, 'idx': 1}))
+        self.assertEqual(response.content.decode(), self.chunks[1]['html'])
+
+        # セッションなど以外に読むのは、その断片のキーだけ
+        script_keys = [call.args[0] for call in cache_get.call_args_list
+            if call.args[0].startswith('script:')]
+        self.assertEqual(script_keys,
+            [script_cache_key(self.script, 'chunk', 1)])
+
+    def test_rebuild_evicted_chunk(self):
+        self.client.get(reverse('script:scrpt_toc',
+            kwargs={'pk': self.script.pk}))
+        cache.delete(script_cache_key(self.script, 'chunk', 1))
+
+        response = self.client.get(reverse('script:scrpt_chunk',
+            kwargs={'pk': self.script.pk, 'idx': 1}))
+        self.assertEqual(response.content.decode(), self.chunks[1]['html'])
+
+
+
+class ScriptViewerTest(TestCase):
+    '''保存されていない台本の HTML を、表示する時に作ることのテスト
+    '''
+    def setUp(self):
+        self.user = User.objects.create_user('tester', password='password')
+        self.client.force_login(self.user)
+        self.script = Script.objects.create(title='テスト台本',
+            raw_data=SCRIPT_TEXT, owner=self.user)
+        Script.objects.filter(pk=self.script.pk).update(html='')
+        self.url = reverse('script:scrpt_viewer',
+            kwargs={'pk': self.script.pk})
+    
+    def test_backfill_html(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.content.decode(),
+            html_from_fountain(SCRIPT_TEXT))
+        self.assertEqual(Script.objects.get(pk=self.script.pk).html,
+            html_from_fountain(SCRIPT_TEXT))
+    
+    def test_update_while_rendering(self):
+        # HTML を作っている間に、台本が変更された場合
+        new_text = SCRIPT_TEXT.replace('さようなら。', 'またね。')
+        
+        def render_and_update(text):
+            script = Script.objects.get(pk=self.script.pk)
+            script.raw_data = new_text
+            script.save()
+            return html_from_fountain(text)
+        
+        with mock.patch('script.views.views.html_from_fountain',
+                side_effect=render_and_update):
+            response = self.client.get(self.url)
+        
+        # 古い台本の HTML を返すが、保存はしない
+        self.assertEqual(response.content.decode(),
+            html_from_fountain(SCRIPT_TEXT))
+        self.assertEqual(Script.objects.get(pk=self.script.pk).html,
+            html_from_fountain(new_text))
+
+def fountain_text(scenes):
+    '''シーン名と、セリフを言う登場人物のリストから台本を作る
+    '''
+    lines = ['Title: 同期テスト', '']
+    for scene_name, char_names in scenes:
+        lines += ['# ' + scene_name, '']
+        for char_name in char_names:
+            lines += [char_name, 'セリフ。', '']
+    return '\n'.join(lines)
+
+
+class SyncDataFromScriptTest(TestCase):
+    '''台本を元に、既存の公演のデータを更新することのテスト
+    '''
+    def setUp(self):
+        self.user = User.objects.create_user('tester', password='password')
+        self.production = Production.objects.create(name='テスト公演')
+    
+    def import_script(self, scenes):
+        self.script = Script.objects.create(title='同期テスト',
+            raw_data=fountain_text(scenes), owner=self.user)
+        add_data_from_script(self.production.id, self.script.id)
+    
+    def sync_script(self, scenes):
+        self.script.raw_data = fountain_text(scenes)
+        self.script.save()
+        return sync_data_from_script(self.production.id, self.script.id)
+    
+    def scene_rows(self):
+        return list(Scene.objects.filter(production=self.production)
+            .order_by('sortkey').values_list('id', 'name', 'sortkey'))
+    
+    def appr_rows(self):
+        return set(Appearance.objects.filter(
+            scene__production=self.production).values_list(
+            'id', 'scene__name', 'character__name', 'lines_num'))
+    
+    def test_rename_character(self):
+        self.import_script([('S1', ['TARO', 'HANAKO']), ('S2', ['HANAKO'])])
+        taro = Character.objects.get(production=self.production, name='TARO')
+        
+        stats = self.sync_script([('S1', ['TARO', 'HANA']), ('S2', ['HANA'])])
+        
+        self.assertEqual(stats['characters'],
+            {'created': 1, 'updated': 0, 'deleted': 1})
+        self.assertEqual(stats['appearances'],
+            {'created': 2, 'updated': 0, 'deleted': 2})
+        self.assertEqual(list(Character.objects.filter(
+            production=self.production).order_by('sortkey')
+            .values_list('name', flat=True)), ['TARO', 'HANA'])
+        self.assertTrue(Character.objects.filter(pk=taro.pk).exists())
+        self.assertEqual(set(Appearance.objects.filter(
+            scene__production=self.production).values_list(
+            'scene__name', 'character__name')),
+            {('S1', 'TARO'), ('S1', 'HANA'), ('S2', 'HANA')})
+    
+    def test_reorder_scenes(self):
+        self.import_script([('S1', ['TARO']), ('S2', ['HANAKO']),
+            ('S3', ['TARO', 'HANAKO'])])
+        scene_ids = {name: scn_id for scn_id, name, _ in self.scene_rows()}
+        appr_rows = self.appr_rows()
+        
+        stats = self.sync_script([('S3', ['TARO', 'HANAKO']),
+            ('S1', ['TARO']), ('S2', ['HANAKO'])])
+        
+        self.assertEqual(stats['scenes'],
+            {'created': 0, 'updated': 3, 'deleted': 0})
+        self.assertEqual(self.scene_rows(), [(scene_ids['S3'], 'S3', 0),
+            (scene_ids['S1'], 'S1', 1), (scene_ids['S2'], 'S2', 2)])
+        self.assertEqual(self.appr_rows(), appr_rows)
+    
+    def test_duplicate_scene_names(self):
+        # 同名のシーンは、同名の中の順番で対応させる
+        self.import_script([('A', ['TARO']), ('B', ['HANAKO']),
+            ('A', ['JIRO'])])
+        (a1_id, _, _), (b_id, _, _), (a2_id, _, _) = self.scene_rows()
+        appr_rows = self.appr_rows()
+        
+        stats = self.sync_script([('A', ['TARO']), ('A', ['JIRO']),
+            ('B', ['HANAKO'])])
+        
+        self.assertEqual(stats['scenes'],
+            {'created': 0, 'updated': 2, 'deleted': 0})
+        self.assertEqual(self.scene_rows(),
+            [(a1_id, 'A', 0), (a2_id, 'A', 1), (b_id, 'B', 2)])
+        self.assertEqual(self.appr_rows(), appr_rows)
+        
+        # 同名のシーンが減れば、後のものを削除する
+        stats = self.sync_script([('A', ['TARO']), ('B', ['HANAKO'])])
+        self.assertEqual(stats['scenes'],
+            {'created': 0, 'updated': 1, 'deleted': 1})
+        self.assertEqual(self.scene_rows(), [(a1_id, 'A', 0), (b_id, 'B', 1)])
+    
+    def test_related_data_survives(self):
+        self.import_script([('S1', ['TARO', 'HANAKO']), ('S2', ['HANAKO']),
+            ('S3', ['TARO'])])
+        actor = Actor.objects.create(production=self.production, name='三橋')
+        Character.objects.filter(production=self.production, name='TARO')\
+            .update(cast=actor)
+        rehearsal = Rehearsal.objects.create(production=self.production,
+            date=date(2021, 4, 1), start_time=time(13, 0),
+            end_time=time(17, 0))
+        Attendance.objects.create(rehearsal=rehearsal, actor=actor,
+            is_allday=True)
+        scenes = {scene.name: scene
+            for scene in Scene.objects.filter(production=self.production)}
+        ScnComment.objects.create(scene=scenes['S1'], comment='残る')
+        ScnComment.objects.create(scene=scenes['S3'], comment='消える')
+        
+        # S3 を削除し、S1 と S2 を入れ替える
+        self.sync_script([('S2', ['HANAKO']), ('S1', ['TARO', 'HANAKO'])])
+        
+        taro = Character.objects.get(production=self.production, name='TARO')
+        self.assertEqual(taro.cast, actor)
+        self.assertEqual(Attendance.objects.filter(actor=actor).count(), 1)
+        self.assertEqual(list(ScnComment.objects.filter(
+            scene__production=self.production)
+            .values_list('scene_id', 'comment')),
+            [(scenes['S1'].id, '残る')])
+    
+    def test_second_run_changes_nothing(self):
+        scenes = [('S1', ['TARO', 'HANAKO']), ('S2', ['HANAKO', 'HANAKO'])]
+        self.import_script(scenes)
+        scene_rows = self.scene_rows()
+        appr_rows = self.appr_rows()
+        
+        for _ in range(2):
+            stats = self.sync_script(scenes)
+            for name in ('characters', 'scenes', 'appearances'):
+                self.assertEqual(stats[name],
+                    {'created': 0, 'updated': 0, 'deleted': 0})
+            self.assertEqual(self.scene_rows(), scene_rows)
+            self.assertEqual(self.appr_rows(), appr_rows)
+
+
+# 要素の種類ごとのパースの結果を確かめる台本
+FOUNTAIN_CORPUS = '''Title: コーパス
+Credit: written by
+Author: テスト作者
+Draft date:
+    2021/04/01
+    改訂
+
+# 第一幕
+
+## 場面1
+
+= 場面の概要
+
+INT. HOUSE - DAY #1A#
+
+ト書きの1行目。
+ト書きの2行目。
+
+TARO
+こんにちは。
+(smiling)
+元気ですか。
+
+@三橋
+はい。
+
+@HANAKO ^
+いいえ。
+
+> 中央のト書き <
+
+CUT TO:
+
+.回想
+
+EXT 森 - 夜
+
+[[メモ]]
+
+/* 削除した
+場面 */
+
+/* 1行の削除 */
+
+JIRO
+(小声)
+あの。
+
+I/E. CAR #2#
+
+===
+
+FADE OUT.
+
+> THE END
+'''
+
+# FOUNTAIN_CORPUS の要素 (空行を除く)
+# (種類, テキスト, 見出しの深さ, シーン番号, シーンの略号, 中央寄せ,
+#  デュアルダイアログ, 行番号)
+FOUNTAIN_CORPUS_ELEMENTS = [
+    ('Section Heading', '第一幕', 1, '', '.', False, False, 0),
+    ('Section Heading', '場面1', 2, '', '.', False, False, 2),
+    ('Synopsis', '場面の概要', 0, '', '.', False, False, 4),
+    ('Scene Heading', 'HOUSE - DAY', 0, '1A', 'INT.', False, False, 6),
+    ('Action', 'ト書きの1行目。\nト書きの2行目。', 0, '', '.', False, False, 8),
+    ('Character', 'TARO', 0, '', '.', False, False, 11),
+    ('Dialogue', 'こんにちは。', 0, '', '.', False, False, 12),
+    ('Parenthetical', '(smiling)', 0, '', '.', False, False, 13),
+    ('Dialogue', '元気ですか。', 0, '', '.', False, False, 14),
+    ('Character', '三橋', 0, '', '.', False, True, 16),
+    ('Dialogue', 'はい。', 0, '', '.', False, False, 17),
+    ('Character', 'HANAKO', 0, '', '.', False, True, 19),
+    ('Dialogue', 'いいえ。', 0, '', '.', False, False, 20),
+    ('Action', '中央のト書き', 0, '', '.', True, False, 22),
+    ('Transition', 'CUT TO:', 0, '', '.', False, False, 24),
+    ('Scene Heading', '回想', 0, '', '.', False, False, 26),
+    ('Scene Heading', '森 - 夜', 0, '', 'EXT', False, False, 28),
+    ('Comment', 'メモ', 0, '', '.', False, False, 30),
+    ('Boneyard', '\n場面', 0, '', '.', False, False, 33),
+    ('Boneyard', ' 1行の削除 ', 0, '', '.', False, False, 35),
+    ('Character', 'JIRO', 0, '', '.', False, False, 37),
+    ('Parenthetical', '(小声)', 0, '', '.', False, False, 38),
+    ('Dialogue', 'あの。', 0, '', '.', False, False, 39),
+    ('Scene Heading', 'CAR', 0, '2', 'I/E.', False, False, 41),
+    ('Page Break', '===', 0, '', '.', False, False, 43),
+    ('Transition', 'FADE OUT.', 0, '', '.', False, False, 45),
+    ('Transition', 'THE END', 0, '', '.', False, False, 47),
+]
+
+
+def element_values(elements):
+    '''比べるために、要素の属性をタプルにする
+    '''
+    return [(e.element_type, e.element_text, e.section_depth, e.scene_number,
+        e.scene_abbreviation, e.is_centered, e.is_dual_dialogue,
+        e.original_line) for e in elements]
+
+
+class FountainParserTest(TestCase):
+    '''Fountain フォーマットのパースのテスト
+    '''
+    def test_corpus(self):
+        script = fountain.Fountain(string=FOUNTAIN_CORPUS)
+        self.assertEqual(script.metadata, {
+            'title': ['コーパス'],
+            'credit': ['written by'],
+            'author': ['テスト作者'],
+            'draft date': ['2021/04/01', '改訂'],
+        })
+        self.assertEqual(element_values(e for e in script.elements
+            if e.element_type != 'Empty Line'), FOUNTAIN_CORPUS_ELEMENTS)
+        self.assertEqual(len(script.elements),
+            len(FOUNTAIN_CORPUS_ELEMENTS) + 19)
+        
+        # 空行を作らなくても、他の要素は同じ
+        script = fountain.Fountain(string=FOUNTAIN_CORPUS,
+            skip_empty_lines=True)
+        self.assertEqual(element_values(script.elements),
+            FOUNTAIN_CORPUS_ELEMENTS)
+        
+        # 1行ずつ読んでも同じ
+        reader = fountain.FountainReader(fountain.iter_lines(FOUNTAIN_CORPUS),
+            skip_empty_lines=True)
+        self.assertEqual(element_values(reader), FOUNTAIN_CORPUS_ELEMENTS)
+    
+    def test_dual_dialogue(self):
+        # '^' は、直前のセリフのまとまりのセリフ主をデュアルダイアログにする
+        script = fountain.Fountain(string='\n'.join(['ト書き。', '', 'TARO', 'はい。',
+            '(間)', 'いいえ。', '', '@HANAKO ^', 'どうも。']))
+        self.assertEqual([e.is_dual_dialogue for e in script.elements
+            if e.element_type == 'Character'], [True, True])
+        
+        # ト書きや見出しを挟むと、前のセリフ主は変えない
+        for between in ('ト書き。', '# 見出し', 'CUT TO:'):
+            script = fountain.Fountain(string='\n'.join(['ト書き。', '',
+                'TARO', 'はい。', '', between, '', '@HANAKO ^', 'どうも。']))
+            self.assertEqual([(e.element_text, e.is_dual_dialogue)
+                for e in script.elements if e.element_type == 'Character'],
+                [('TARO', False), ('HANAKO', True)], between)
+    
+    def test_reader_holds_back_only_dialogue_block(self):
+        # セリフのまとまりが終われば、後を読まずにセリフ主を返す
+        read_lines = []
+        
+        def lines():
+            for line in ['ト書き。', '', 'TARO', 'はい。', '', 'ト書き。']:
+                read_lines.append(line)
+                yield line
+            for idx in range(10000):
+                read_lines.append(idx)
+                yield ''
+                yield 'ト書き。'
+        
+        reader = iter(fountain.FountainReader(lines(), skip_empty_lines=True))
+        self.assertEqual(next(reader).element_text, 'ト書き。')
+        self.assertEqual(next(reader).element_text, 'TARO')
+        self.assertLess(len(read_lines), 10)
+    
+    def test_parse_parallel(self):
+        # 見出しで区切ってパースしても、行番号を含めて同じ要素になる
+        text = FOUNTAIN_CORPUS + '\n\n' + '\n\n'.join(
+            FOUNTAIN_CORPUS.split('\n\n', 1)[1] for _ in range(5))
+        body = text.split('\n\n', 1)[1].splitlines()
+        self.assertGreater(len(fountain._chunk_starts(body, 20)), 5)
+        
+        for skip_empty_lines in (False, True):
+            script = fountain.Fountain(string=text,
+                skip_empty_lines=skip_empty_lines)
+            with ThreadPoolExecutor(2) as executor:
+                metadata, elements = fountain.parse_parallel(text, executor,
+                    min_chunk_lines=20, skip_empty_lines=skip_empty_lines)
+            self.assertEqual(metadata, script.metadata)
+            self.assertEqual(element_values(elements),
+                element_values(script.elements))
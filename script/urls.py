@@ -18,8 +18,16 @@ urlpatterns = [
     # /scrpt/scrpt_viewer/1/ -> Script #1 Viewer
     path('scrpt_viewer/<int:pk>/', views.ScriptViewer.as_view(),
         name='scrpt_viewer'),
+    # /scrpt/scrpt_toc/1/ -> Script #1 Viewer by chunks
+    path('scrpt_toc/<int:pk>/', views.ScriptToc.as_view(), name='scrpt_toc'),
+    # /scrpt/scrpt_chunk/1/0/ -> Chunk #0 of Script #1
+    path('scrpt_chunk/<int:pk>/<int:idx>/', views.ScriptChunk.as_view(),
+        name='scrpt_chunk'),
     
     # /scrpt/prod_from_scrpt/1/ -> Create Production from Script #1
     path('prod_from_scrpt/<int:scrpt_id>/', views.ProdFromScript.as_view(),
         name='prod_from_scrpt'),
+    # /scrpt/prod_sync/1/ -> Update a Production from Script #1
+    path('prod_sync/<int:scrpt_id>/', views.ProdSyncFromScript.as_view(),
+        name='prod_sync'),
 ]
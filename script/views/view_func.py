@@ -1,11 +1,100 @@
+import hashlib
+import sys
+import threading
+from collections import OrderedDict
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date
 from production.models import Production
 from rehearsal.models import Character, Scene, Appearance
 from script.fountain import fountain
 from script.models import Script
 
 
+# パースした台本のキャッシュ (台本のハッシュ -> (バイト数, メタデータ, 要素))
+# 古く使われたものから捨てる
+_parsed_scripts = OrderedDict()
+_parsed_scripts_size = 0
+_parsed_scripts_lock = threading.Lock()
+
+
+def parsed_fountain(text):
+    '''Fountain フォーマットの台本をパースした結果を、キャッシュを使って取得する
+
+    台本のテキストのハッシュをキーにするので、変更されればパースし直す
+    パースした結果のおよそのバイト数で、キャッシュの上限を数える
+    キャッシュの上限より長い台本は、キャッシュせずに1つずつ読む
+
+    Parameters
+    ----------
+    text : str
+        台本のテキストデータ
+
+    Returns
+    -------
+    metadata : dict
+        タイトルページの情報
+    elements : iterable
+        空行を除いた FountainElement (共有されるので変更しないこと)
+    '''
+    global _parsed_scripts_size
+
+    max_size = settings.SCRIPT_PARSE_CACHE_SIZE
+    # パースした結果は、少なくとも台本の文字数のバイト数になる
+    if len(text) > max_size:
+        reader = fountain.FountainReader(fountain.iter_lines(text),
+            skip_empty_lines=True)
+        return reader.metadata, reader
+
+    key = hashlib.sha1(text.encode()).hexdigest()
+    with _parsed_scripts_lock:
+        parsed = _parsed_scripts.get(key)
+        if parsed is not None:
+            _parsed_scripts.move_to_end(key)
+            return parsed[1], parsed[2]
+
+    # パースはロックの外で行う
+    reader = fountain.FountainReader(text, skip_empty_lines=True)
+    elements = tuple(reader)
+    parsed = (parsed_size(elements), reader.metadata, elements)
+    if parsed[0] > max_size:
+        return parsed[1], parsed[2]
+
+    with _parsed_scripts_lock:
+        if key not in _parsed_scripts:
+            _parsed_scripts[key] = parsed
+            _parsed_scripts_size += parsed[0]
+        # 上限を超えたら、古く使われたものから捨てる
+        while _parsed_scripts_size > max_size:
+            _, (size, _, _) = _parsed_scripts.popitem(last=False)
+            _parsed_scripts_size -= size
+
+    return parsed[1], parsed[2]
+
+
+def parsed_size(elements):
+    '''パースした台本の要素の、およそのバイト数を返す
+
+    要素とそのテキストの大きさの合計 (台本の文字数のおよそ 15 倍になる)
+    '''
+    return sys.getsizeof(elements) + sum(sys.getsizeof(e)
+        + sys.getsizeof(e.element_text) + sys.getsizeof(e.original_content)
+        for e in elements)
+
+
+@transaction.atomic
 def add_data_from_script(prod_id, scrpt_id):
     '''台本を元に公演にシーン、登場人物、出番を追加する
+
+    1つのトランザクションで、テーブルごとにまとめて INSERT する
+
+    Returns
+    -------
+    stats : dict
+        追加した登場人物 (characters)、シーン (scenes)、出番 (appearances)
+        の数. 台本または公演がなければ None
     '''
     # 台本データを取得
     scripts = Script.objects.filter(pk=scrpt_id)
@@ -28,33 +117,232 @@ def add_data_from_script(prod_id, scrpt_id):
     # 登場人物を追加しながらインスタンスを記録する
     char_instances = {}
     for idx, char_name in enumerate(characters):
-        character = Character(production=production,
+        char_instances[char_name] = Character(production=production,
             name=char_name, sortkey=idx)
-        character.save()
-        char_instances[char_name] = character
+    bulk_create_with_pks(Character, list(char_instances.values()), 'name')
 
-    # シーンと出番を追加
+    # シーンを追加
+    scene_instances = []
     for idx, scene_name in enumerate(scenes):
         # 出番のセリフ数の合計を出しておく
-        scn_appr = appearance[idx]
-        scn_lines_num = sum(scn_appr.values())
-        # インスタンス生成、保存
-        scene = Scene(
+        scn_lines_num = sum(appearance[idx].values())
+        scene_instances.append(Scene(
             production=production,
             name=scene_name,
             sortkey=idx,
             length=scn_lines_num,
             length_auto=False,
-        )
-        scene.save()
-        # 出番の追加
+        ))
+    bulk_create_with_pks(Scene, scene_instances, 'sortkey')
+
+    # 出番を追加
+    appr_instances = []
+    for scene, scn_appr in zip(scene_instances, appearance):
         for char_name, lines_num in scn_appr.items():
-            appr = Appearance(
+            appr_instances.append(Appearance(
                 scene=scene,
                 character=char_instances[char_name],
                 lines_num=lines_num,
+            ))
+    Appearance.objects.bulk_create(appr_instances)
+
+    # bulk_create() ではシグナルが送られないので、バージョンを進める
+    Production.update_data_version(prod_id)
+
+    return {
+        'characters': len(char_instances),
+        'scenes': len(scene_instances),
+        'appearances': len(appr_instances),
+    }
+
+
+@transaction.atomic
+def sync_data_from_script(prod_id, scrpt_id):
+    '''台本を元に、既存の公演のシーン、登場人物、出番を更新する
+
+    登場人物は名前で、シーンは名前と (同名のシーンの中の) 順番で対応させ、
+    追加、更新、削除が必要なレコードだけを、テーブルごとにまとめて処理する
+    対応するレコードは残すので、配役、出欠、コメントなどは保たれる
+
+    Returns
+    -------
+    stats : dict
+        登場人物 (characters)、シーン (scenes)、出番 (appearances) ごとの、
+        追加 (created)、更新 (updated)、削除 (deleted) した数
+        台本または公演がなければ None
+    '''
+    # 台本データを取得
+    scripts = Script.objects.filter(pk=scrpt_id)
+    if scripts.count() < 1:
+        return
+    script = scripts[0]
+
+    # 台本データが Fountain フォーマットの場合のデータ取得
+    if script.format == 1:
+        characters, scenes, appearance = data_from_fountain(script.raw_data)
+    else:
+        return
+
+    # データを更新する公演
+    prods = Production.objects.filter(pk=prod_id)
+    if prods.count() < 1:
+        return
+    production = prods[0]
+
+    # 登場人物を名前で対応させる (同名があれば先のものを使う)
+    old_chars = {}
+    del_chars = []
+    for character in Character.objects.filter(production=production)\
+            .order_by('sortkey', 'id'):
+        if character.name in old_chars:
+            del_chars.append(character)
+        else:
+            old_chars[character.name] = character
+
+    char_instances = {}
+    new_chars = []
+    upd_chars = []
+    for idx, char_name in enumerate(characters):
+        character = old_chars.pop(char_name, None)
+        if character is None:
+            character = Character(production=production,
+                name=char_name, sortkey=idx)
+            new_chars.append(character)
+        elif character.sortkey != idx:
+            character.sortkey = idx
+            upd_chars.append(character)
+        char_instances[char_name] = character
+    del_chars.extend(old_chars.values())
+
+    bulk_create_with_pks(Character, new_chars, 'name')
+    Character.objects.bulk_update(upd_chars, ['sortkey'])
+
+    # シーンを名前と順番で対応させる
+    old_scenes = {}
+    for scene in Scene.objects.filter(production=production)\
+            .order_by('sortkey', 'id'):
+        old_scenes.setdefault(scene.name, []).append(scene)
+    for same_name_scenes in old_scenes.values():
+        same_name_scenes.reverse()
+
+    scene_instances = []
+    new_scenes = []
+    upd_scenes = []
+    for idx, scene_name in enumerate(scenes):
+        # 出番のセリフ数の合計を出しておく
+        scn_lines_num = sum(appearance[idx].values())
+        same_name_scenes = old_scenes.get(scene_name)
+        if same_name_scenes:
+            scene = same_name_scenes.pop()
+            if (scene.sortkey, scene.length, scene.length_auto)\
+                    != (idx, scn_lines_num, False):
+                scene.sortkey = idx
+                scene.length = scn_lines_num
+                scene.length_auto = False
+                upd_scenes.append(scene)
+        else:
+            scene = Scene(
+                production=production,
+                name=scene_name,
+                sortkey=idx,
+                length=scn_lines_num,
+                length_auto=False,
             )
-            appr.save()
+            new_scenes.append(scene)
+        scene_instances.append(scene)
+    del_scenes = [scene for same_name_scenes in old_scenes.values()
+        for scene in same_name_scenes]
+
+    bulk_create_with_pks(Scene, new_scenes, 'sortkey')
+    Scene.objects.bulk_update(upd_scenes,
+        ['sortkey', 'length', 'length_auto'])
+
+    # 出番をシーンと登場人物で対応させる (重複があれば先のものを使う)
+    old_apprs = {}
+    del_apprs = []
+    for appr in Appearance.objects.filter(scene__production=production)\
+            .order_by('id'):
+        key = (appr.scene_id, appr.character_id)
+        if key in old_apprs:
+            del_apprs.append(appr)
+        else:
+            old_apprs[key] = appr
+
+    new_apprs = []
+    upd_apprs = []
+    for scene, scn_appr in zip(scene_instances, appearance):
+        for char_name, lines_num in scn_appr.items():
+            character = char_instances[char_name]
+            appr = old_apprs.pop((scene.pk, character.pk), None)
+            if appr is None:
+                new_apprs.append(Appearance(
+                    scene=scene,
+                    character=character,
+                    lines_num=lines_num,
+                ))
+            elif (appr.lines_num, appr.lines_auto) != (lines_num, False):
+                appr.lines_num = lines_num
+                appr.lines_auto = False
+                upd_apprs.append(appr)
+    del_apprs.extend(old_apprs.values())
+
+    Appearance.objects.bulk_create(new_apprs)
+    Appearance.objects.bulk_update(upd_apprs, ['lines_num', 'lines_auto'])
+
+    # 台本にないものを削除 (出番は先に消しておく)
+    for model, objs in ((Appearance, del_apprs), (Scene, del_scenes),
+            (Character, del_chars)):
+        if objs:
+            model.objects.filter(pk__in=[obj.pk for obj in objs]).delete()
+
+    # bulk_create() などではシグナルが送られないので、バージョンを進める
+    Production.update_data_version(prod_id)
+
+    stats = {}
+    for name, created, updated, deleted in (
+            ('characters', new_chars, upd_chars, del_chars),
+            ('scenes', new_scenes, upd_scenes, del_scenes),
+            ('appearances', new_apprs, upd_apprs, del_apprs)):
+        stats[name] = {'created': len(created), 'updated': len(updated),
+            'deleted': len(deleted)}
+
+    return stats
+
+
+def bulk_create_with_pks(model, objs, key_field):
+    '''公演に属するレコードをまとめて追加し、インスタンスに id をセットする
+
+    id を返せないデータベースでは、追加する前の最大の id より大きい
+    レコードを読み直し、key_field の値でインスタンスと対応させる
+    (同時に他のユーザが同じ公演にレコードを追加しても、取り違えない)
+
+    Parameters
+    ----------
+    model : Model
+        追加するレコードのモデル
+    objs : list
+        追加するインスタンスのリスト
+    key_field : str
+        objs の中で値が一意になるフィールドの名前
+    '''
+    if not objs:
+        return
+    if connection.features.can_return_rows_from_bulk_insert:
+        model.objects.bulk_create(objs)
+        return
+
+    production = objs[0].production
+    last_pk = model.objects.filter(production=production)\
+        .order_by('-id').values_list('id', flat=True).first() or 0
+    model.objects.bulk_create(objs)
+
+    # 同じ値のレコードがあれば、先に追加されたものを使う
+    pks = {}
+    for pk, key in model.objects.filter(production=production,
+            id__gt=last_pk).order_by('id').values_list('id', key_field):
+        pks.setdefault(key, pk)
+    for obj in objs:
+        obj.pk = pks[getattr(obj, key_field)]
 
 
 def data_from_fountain(text):
@@ -75,15 +363,35 @@ def data_from_fountain(text):
         シーンごとの、出番 (dict) のリスト
     '''
 
-    # パース
-    f = fountain.Fountain(string=text)
+    # パース (同じ台本ならキャッシュから)
+    _, elements = parsed_fountain(text)
 
+    return data_from_elements(elements)
+
+
+def data_from_elements(elements):
+    '''パースした台本の要素からデータを取得
+
+    Parameters
+    ----------
+    elements : iterable
+        FountainElement
+
+    Returns
+    -------
+    characters : list
+        Character 行から取得した登場人物名のリスト
+    scenes : list
+        Scene Heading 行または Section Heading 行から取得したシーン名のリスト
+    appearance : list
+        シーンごとの、出番 (dict) のリスト
+    '''
     characters = []
     scenes = []
     appearance = []
     scn_apprs = {}
 
-    for e in f.elements:
+    for e in elements:
         # セリフ主の行
         if e.element_type == 'Character':
             # 少なくとも1個のシーンが検出されていれば
@@ -121,6 +429,20 @@ def data_from_fountain(text):
     return characters, scenes, appearance
 
 
+# ビューアの HTML の前後
+VIEWER_HTML_HEAD = '<html lang="ja">'\
+    '<head>'\
+    '<meta charset="utf-8">'\
+    '<meta name="viewport" content="width=device-width, '\
+    'initial-scale=1.0, user-scalable=yes">'\
+    '</head>'\
+    '<body>'
+VIEWER_HTML_TAIL = '</body></html>'
+
+# 目次で区切る見出し
+CHUNK_HEADING_TYPES = ('Section Heading', 'Scene Heading')
+
+
 def html_from_fountain(text):
     '''Fountain フォーマットの台本から HTML を生成
 
@@ -134,26 +456,136 @@ def html_from_fountain(text):
     html : str
         生成した HTML
     '''
+    # パース (同じ台本ならキャッシュから、長い台本は1つずつ読む)
+    metadata, elements = parsed_fountain(text)
+
+    return ''.join(iter_html_from_elements(metadata, elements))
+
+
+def iter_html_from_fountain(text, chunk_size=8192):
+    '''Fountain フォーマットの台本から、パースしながら HTML を少しずつ生成
+
+    キャッシュは使わず、台本を1行ずつ読むので、最初の断片はすぐに返り、
+    メモリの使用量も台本の長さによらない (台本のテキスト自体を除く)
+
+    Parameters
+    ----------
+    text : str
+        台本のテキストデータ
+    chunk_size : int
+        1回に返す HTML のおよその文字数
+
+    Yields
+    ------
+    html : str
+        生成した HTML の断片
+    '''
+    reader = fountain.FountainReader(fountain.iter_lines(text),
+        skip_empty_lines=True)
+    yield from iter_html_from_elements(reader.metadata, reader, chunk_size)
+
+
+def iter_html_from_elements(metadata, elements, chunk_size=8192):
+    '''パースした台本から、HTML を少しずつ生成
+
+    Parameters
+    ----------
+    metadata : dict
+        タイトルページの情報
+    elements : iterable
+        空行を除いた FountainElement
+    chunk_size : int
+        1回に返す HTML のおよその文字数
+
+    Yields
+    ------
+    html : str
+        生成した HTML の断片
+    '''
+    # HTML としての体裁を整える
+    content = [VIEWER_HTML_HEAD, title_html(metadata)]
+    content_size = 0
+
+    for _, html in html_parts_from_elements(elements):
+        content.append(html)
+        content_size += len(html)
+        # ある程度溜まったら返す
+        if content_size >= chunk_size:
+            yield ''.join(content)
+            content = []
+            content_size = 0
 
-    # パース
-    f = fountain.Fountain(string=text)
+    content.append(VIEWER_HTML_TAIL)
+    yield ''.join(content)
+
+
+def html_chunks_from_fountain(text):
+    '''Fountain フォーマットの台本から、見出しごとに区切った HTML を生成
+
+    Parameters
+    ----------
+    text : str
+        台本のテキストデータ
+
+    Returns
+    -------
+    chunks : list
+        見出し (title) と HTML の断片 (html) の dict のリスト
+        繋げると html_from_fountain() の body になる
+    '''
+    metadata, elements = parsed_fountain(text)
 
-    # コンテンツ生成
-    content = ''
+    # 最初の見出しまで (タイトルなど)
+    chunks = [{'title': '(冒頭)', 'html': [title_html(metadata)]}]
+
+    for e, html in html_parts_from_elements(elements):
+        if e.element_type in CHUNK_HEADING_TYPES:
+            chunks.append({'title': e.element_text, 'html': []})
+        chunks[-1]['html'].append(html)
+
+    for chunk in chunks:
+        chunk['html'] = ''.join(chunk['html'])
+
+    # 最初の見出しまでに何もなければ省く
+    if not chunks[0]['html']:
+        chunks.pop(0)
+
+    return chunks
+
+
+def title_html(metadata):
+    '''タイトルページの情報から HTML を生成
+    '''
+    content = []
     # タイトル
-    if 'title' in f.metadata:
-        for title in f.metadata['title']:
-            content += f'<h1>{title}</h1>'
+    if 'title' in metadata:
+        for title in metadata['title']:
+            content.append(f'<h1>{title}</h1>')
     # 著者
-    if 'author' in f.metadata:
-        for author in f.metadata['author']:
-            content += f'<div style="text-align:right;">{author}</div>'
+    if 'author' in metadata:
+        for author in metadata['author']:
+            content.append(f'<div style="text-align:right;">{author}</div>')
+    return ''.join(content)
 
-    for e in f.elements:
-        # 空行をスキップ
-        if e.element_type == 'Empty Line':
-            continue
 
+def html_parts_from_elements(elements):
+    '''台本の要素を1つずつ HTML にする
+
+    Parameters
+    ----------
+    elements : iterable
+        空行を除いた FountainElement
+
+    Yields
+    ------
+    e : FountainElement
+        要素
+    html : str
+        要素の HTML (必要なら直前の空行を含む)
+    '''
+    last_type = None
+
+    for e in elements:
         # 改行の処理をしたテキスト
         text = e.element_text.replace('\n', '<br>')
 
@@ -189,16 +621,94 @@ def html_from_fountain(text):
         if insert_blank:
             line = '<div style="height:15"></div>' + line
 
-        content += line
+        yield e, line
         last_type = e.element_type
 
-    # HTML としての体裁を整える
-    html = '<html lang="ja">'\
-        '<head>'\
-        '<meta charset="utf-8">'\
-        '<meta name="viewport" content="width=device-width, '\
-        'initial-scale=1.0, user-scalable=yes">'\
-        '</head>'\
-        '<body>' + content + '</body></html>'
 
+def script_cache_key(script, *parts):
+    '''台本の目次や断片の、キャッシュのキーを作る
+
+    キーに変更日時を含めるので、変更された後は作り直す
+    '''
+    return ':'.join(['script', str(script.pk),
+        str(script.modify_dt.timestamp())] + [str(part) for part in parts])
+
+
+def cache_script_chunks(script):
+    '''台本を見出しごとに区切った HTML を作り、断片ごとにキャッシュする
+
+    断片を読むたびに台本全体を読み込まないように、目次と断片は別のキーにする
+
+    Returns
+    -------
+    chunks : list
+        html_chunks_from_fountain() の戻り値
+    '''
+    chunks = html_chunks_from_fountain(script.raw_data)
+    cache.set_many({script_cache_key(script, 'chunk', idx): chunk['html']
+        for idx, chunk in enumerate(chunks)})
+    # 目次は最後に入れる (目次があれば断片もある)
+    cache.set(script_cache_key(script, 'toc'),
+        [chunk['title'] for chunk in chunks])
+    return chunks
+
+
+def script_chunk_titles(script):
+    '''台本の見出しのリストを、キャッシュを使って取得する
+    '''
+    titles = cache.get(script_cache_key(script, 'toc'))
+    if titles is None:
+        titles = [chunk['title'] for chunk in cache_script_chunks(script)]
+    return titles
+
+
+def script_chunk_html(script, idx):
+    '''台本の見出しごとの HTML の断片を、キャッシュを使って取得する
+
+    Parameters
+    ----------
+    script : Script
+        台本
+    idx : int
+        断片のインデックス
+
+    Returns
+    -------
+    html : str
+        HTML の断片 (インデックスが範囲外なら None)
+    '''
+    html = cache.get(script_cache_key(script, 'chunk', idx))
+    if html is None:
+        # 期限切れなどでなければ、範囲外
+        titles = cache.get(script_cache_key(script, 'toc'))
+        if titles is not None and idx >= len(titles):
+            return None
+        chunks = cache_script_chunks(script)
+        if idx < len(chunks):
+            html = chunks[idx]['html']
     return html
+
+
+def conditional_script_response(request, script, make_response):
+    '''台本の変更日時を Last-Modified にして、条件付き GET に応える
+
+    Parameters
+    ----------
+    request : HttpRequest
+        リクエスト
+    script : Script
+        表示する台本
+    make_response : function
+        変更されていた時に、レスポンスを作る関数
+    '''
+    # 変更されていなければ 304 を返す
+    last_modified = int(script.modify_dt.timestamp())
+    response = get_conditional_response(request,
+        last_modified=last_modified)
+    if response is None:
+        response = make_response()
+
+    # 毎回検証させる
+    response['Last-Modified'] = http_date(last_modified)
+    patch_cache_control(response, private=True, no_cache=True)
+    return response
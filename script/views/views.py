@@ -1,12 +1,16 @@
-from django.views.generic import ListView, DetailView
+from django.views.generic import ListView, DetailView, TemplateView
 from django.views.generic.edit import CreateView, UpdateView, DeleteView
-from django.urls import reverse_lazy
+from django.urls import reverse, reverse_lazy
 from django.contrib import messages
 from django.contrib.auth.mixins import LoginRequiredMixin
 from django.core.exceptions import PermissionDenied
-from django.http import Http404, HttpResponse
+from django.http import Http404, HttpResponse, HttpResponseRedirect,\
+    StreamingHttpResponse
+from django.conf import settings
+from django.db import transaction
 from django.db.models import Q
 from production.models import Production, ProdUser
+from production.view_func import test_edit_permission
 from script.models import Script
 from .view_func import *
 
@@ -21,7 +25,7 @@ class ScriptList(LoginRequiredMixin, ListView):
         '''
         # 公開されている台本と、所有している台本を表示
         return Script.objects.filter(
-            Q(public_level=2) | Q(owner=self.request.user))
+            Q(public_level=2) | Q(owner=self.request.user)).defer('html')
 
 
 class ScriptCreate(LoginRequiredMixin, CreateView):
@@ -141,21 +145,30 @@ class ProdFromScript(LoginRequiredMixin, CreateView):
     def form_valid(self, form):
         '''バリデーションを通った時
         '''
-        # 保存したレコードを取得する
-        new_prod = form.save(commit=True)
+        # 公演と、台本から作るデータを、まとめて保存する
+        with transaction.atomic():
+            # 保存したレコードを取得する
+            new_prod = form.save(commit=True)
+            
+            # 自分を owner として公演ユーザに追加する
+            prod_user = ProdUser(production=new_prod,
+                user=self.request.user, is_owner=True)
+            prod_user.save()
+            
+            # POST で取得した URLconf
+            scrpt_id = self.kwargs['scrpt_id']
+            # 台本を元に、公演にデータを追加する
+            stats = add_data_from_script(new_prod.id, scrpt_id)
         
-        # 自分を owner として公演ユーザに追加する
-        prod_user = ProdUser(production=new_prod, user=self.request.user,
-            is_owner=True)
-        prod_user.save()
+        msg = str(new_prod) + " を作成しました。"
+        if stats:
+            msg += "(登場人物 {characters}, シーン {scenes}, 出番 {appearances})"\
+                .format(**stats)
+        messages.success(self.request, msg)
         
-        # POST で取得した URLconf
-        scrpt_id = self.kwargs['scrpt_id']
-        # 台本を元に、公演にデータを追加する
-        add_data_from_script(new_prod.id, scrpt_id)
-        
-        messages.success(self.request, str(new_prod) + " を作成しました。")
-        return super().form_valid(form)
+        # 保存済みなので、もう一度保存しない
+        self.object = new_prod
+        return HttpResponseRedirect(self.get_success_url())
     
     def form_invalid(self, form):
         '''追加に失敗した時
@@ -164,12 +177,109 @@ class ProdFromScript(LoginRequiredMixin, CreateView):
         return super().form_invalid(form)
 
 
+class ProdSyncFromScript(LoginRequiredMixin, TemplateView):
+    '''Script データを元に既存の Production のデータを更新するビュー
+    '''
+    template_name = 'script/production_sync_from_script.html'
+    
+    def get(self, request, *args, **kwargs):
+        '''表示時のリクエストを受けるハンドラ
+        '''
+        self.script = self.get_script()
+        return super().get(request, *args, **kwargs)
+    
+    def post(self, request, *args, **kwargs):
+        '''更新時のリクエストを受けるハンドラ
+        '''
+        self.script = self.get_script()
+        
+        # 更新する公演の編集権を検査する
+        prod_id = request.POST.get('prod_id')
+        if not prod_id or not prod_id.isdecimal():
+            raise Http404
+        prod_id = int(prod_id)
+        test_edit_permission(self, prod_id)
+        
+        # 台本を元に、公演のデータを更新する
+        stats = sync_data_from_script(prod_id, self.script.id)
+        if stats is None:
+            raise Http404
+        
+        msg = "公演のデータを更新しました。"
+        for name, label in (('characters', '登場人物'), ('scenes', 'シーン'),
+                ('appearances', '出番')):
+            msg += "({} 追加 {created}, 更新 {updated}, 削除 {deleted})"\
+                .format(label, **stats[name])
+        messages.success(self.request, msg)
+        return HttpResponseRedirect(
+            reverse('rehearsal:rhsl_top', kwargs={'prod_id': prod_id}))
+    
+    def get_script(self):
+        '''URLconf から Script を取得し、アクセス権を検査する
+        '''
+        scripts = Script.objects.filter(pk=self.kwargs['scrpt_id'])
+        if scripts.count() < 1:
+            raise Http404
+        script = scripts[0]
+        
+        # 所有者でもなく、公開もされていなければ、アクセス不可
+        if self.request.user != script.owner and script.public_level != 2:
+            raise PermissionDenied
+        
+        return script
+    
+    def get_context_data(self, **kwargs):
+        '''テンプレートに渡すパラメタを改変する
+        '''
+        context = super().get_context_data(**kwargs)
+        
+        # 編集権を持っている公演を選べるようにする
+        prod_users = ProdUser.objects.filter(user=self.request.user)\
+            .filter(Q(is_owner=True) | Q(is_editor=True))\
+            .select_related('production')
+        context['productions'] = [prod_user.production
+            for prod_user in prod_users]
+        
+        return context
+
+
 class ScriptViewer(LoginRequiredMixin, DetailView):
     '''Script データから作った HTML を表示するビュー
     '''
 
     model = Script
 
+    def get(self, request, *args, **kwargs):
+        '''表示時のリクエストを受けるハンドラ
+        '''
+        script = self.get_object()
+        
+        # 所有者でもなく、公開もされていなければ、アクセス不可
+        if self.request.user != script.owner and script.public_level != 2:
+            raise PermissionDenied
+        
+        def make_response():
+            # 長い台本は、パースしながら少しずつ送る
+            if len(script.raw_data) > settings.SCRIPT_VIEWER_STREAMING_SIZE:
+                return StreamingHttpResponse(
+                    iter_html_from_fountain(script.raw_data))
+            # 保存時に作った HTML (なければここで作って保存する)
+            # 作っている間に台本が変更されていたら、保存しない
+            if not script.html:
+                script.html = html_from_fountain(script.raw_data)
+                Script.objects.filter(pk=script.pk,
+                    modify_dt=script.modify_dt).update(html=script.html)
+            return HttpResponse(script.html)
+        
+        return conditional_script_response(request, script, make_response)
+
+
+class ScriptToc(LoginRequiredMixin, DetailView):
+    '''Script の目次を表示し、見出しごとの HTML を順に読み込むビュー
+    '''
+    model = Script
+    template_name = 'script/script_toc.html'
+
     def get(self, request, *args, **kwargs):
         '''表示時のリクエストを受けるハンドラ
         '''
@@ -178,5 +288,37 @@ class ScriptViewer(LoginRequiredMixin, DetailView):
             and self.get_object().public_level != 2:
             raise PermissionDenied
         
-        html = html_from_fountain(self.get_object().raw_data)
-        return HttpResponse(html)
+        return super().get(request, *args, **kwargs)
+    
+    def get_context_data(self, **kwargs):
+        '''テンプレートに渡すパラメタを改変する
+        '''
+        context = super().get_context_data(**kwargs)
+        
+        # 見出しのリスト
+        context['chunk_titles'] = script_chunk_titles(self.object)
+        
+        return context
+
+
+class ScriptChunk(LoginRequiredMixin, DetailView):
+    '''Script の見出しごとの HTML の断片を返すビュー
+    '''
+    model = Script
+
+    def get(self, request, *args, **kwargs):
+        '''表示時のリクエストを受けるハンドラ
+        '''
+        script = self.get_object()
+        
+        # 所有者でもなく、公開もされていなければ、アクセス不可
+        if self.request.user != script.owner and script.public_level != 2:
+            raise PermissionDenied
+        
+        def make_response():
+            html = script_chunk_html(script, self.kwargs['idx'])
+            if html is None:
+                raise Http404
+            return HttpResponse(html)
+        
+        return conditional_script_response(request, script, make_response)